@@ -1,17 +1,27 @@
 #!/usr/bin/env python
 
 import os
+import re
+import sys
 import time
 import datetime
 import logging
 import argparse
 import json
+import gzip
+import bz2
+import heapq
+import tempfile
+import collections
+import multiprocessing
 
 import pymongo
 import requests
 from lxml import etree
 import dateutil.parser
 
+from arxiv_download_metadata import metadata_output_file_name, find_metadata_file, open_metadata_file
+
 
 logger = logging.getLogger(__name__)
 
@@ -39,30 +49,30 @@ def parse_metadata_arXiv(record_element):
     if arxiv_element is None:
         return
     
-    oai_id = first(header_element.xpath('oai:identifier/text()', namespaces=ns))
-    oai_datestamp = first(header_element.xpath('oai:datestamp/text()', namespaces=ns))
+    oai_id = first(header_element.xpath('oai:identifier/text()', namespaces=ns, smart_strings=False))
+    oai_datestamp = first(header_element.xpath('oai:datestamp/text()', namespaces=ns, smart_strings=False))
     oai_specs = [subel.text for subel in header_element.findall('oai:setSpec', namespaces=ns)]
     
-    arxiv_id = first(arxiv_element.xpath('arxiv:id/text()', namespaces=ns), require=True)
+    arxiv_id = first(arxiv_element.xpath('arxiv:id/text()', namespaces=ns, smart_strings=False), require=True)
     
     authors_element = arxiv_element.find('arxiv:authors', namespaces=ns)
     authors = []
     for author_element in authors_element.findall('arxiv:author', namespaces=ns):
-        keyname = first(author_element.xpath('arxiv:keyname/text()', namespaces=ns))
-        forenames = first(author_element.xpath('arxiv:forenames/text()', namespaces=ns))
+        keyname = first(author_element.xpath('arxiv:keyname/text()', namespaces=ns, smart_strings=False))
+        forenames = first(author_element.xpath('arxiv:forenames/text()', namespaces=ns, smart_strings=False))
         authors.append({
                 'keyname': keyname, 
                 'forenames': forenames,
-                'name': ' '.join(author_element.xpath('*/text()', namespaces=ns)),
+                'name': ' '.join(author_element.xpath('*/text()', namespaces=ns, smart_strings=False)),
             })
-    title = first(arxiv_element.xpath('arxiv:title/text()', namespaces=ns), require=True)
-    abstract = first(arxiv_element.xpath('arxiv:abstract/text()', namespaces=ns), require=True).strip()
-    categories = first(arxiv_element.xpath('arxiv:categories/text()', namespaces=ns), require=True)
-    categories = filter(lambda s: len(s) > 0, categories.split(' ')) 
+    title = first(arxiv_element.xpath('arxiv:title/text()', namespaces=ns, smart_strings=False), require=True)
+    abstract = first(arxiv_element.xpath('arxiv:abstract/text()', namespaces=ns, smart_strings=False), require=True).strip()
+    categories = first(arxiv_element.xpath('arxiv:categories/text()', namespaces=ns, smart_strings=False), require=True)
+    categories = [s for s in categories.split(' ') if len(s) > 0]
     
     info = {}
     for subelement in arxiv_element:
-        tag = subelement.xpath('local-name()')
+        tag = subelement.xpath('local-name()', smart_strings=False)
         if tag not in ('id', 'title', 'authors', 'categories', 'abstract'):
             info[tag] = subelement.text
     
@@ -96,16 +106,16 @@ def parse_metadata_arXivRaw(record_element):
     if arxiv_element is None:
         return
     
-    arxiv_id = first(arxiv_element.xpath('arxiv:id/text()', namespaces=ns), require=True)
+    arxiv_id = first(arxiv_element.xpath('arxiv:id/text()', namespaces=ns, smart_strings=False), require=True)
     
-    submitter = first(arxiv_element.xpath('arxiv:submitter/text()', namespaces=ns))
+    submitter = first(arxiv_element.xpath('arxiv:submitter/text()', namespaces=ns, smart_strings=False))
     
     versions = []
     for version_element in arxiv_element.findall('arxiv:version', namespaces=ns):
         version = version_element.attrib['version']
         
-        date = first(version_element.xpath('arxiv:date/text()', namespaces=ns))
-        size = first(version_element.xpath('arxiv:size/text()', namespaces=ns))
+        date = first(version_element.xpath('arxiv:date/text()', namespaces=ns, smart_strings=False))
+        size = first(version_element.xpath('arxiv:size/text()', namespaces=ns, smart_strings=False))
         date = dateutil.parser.parse(date).strftime('%Y-%m-%d %H:%M:%S')
         versions.append({'version': version, 'size': size, 'date': date})
     
@@ -116,97 +126,322 @@ def parse_metadata_arXivRaw(record_element):
     }
 
 
-def collect_metadata(metadata_collection, metadata_dir):
-    
+def list_delta_dates(metadata_dir, metadata_prefix):
     """
-    logger.info('Start reading arXiv metadata')
-    
+    Find labels (from-dates, with harvest time if repeated) of incremental
+    page sequences written by arxiv_download_metadata, in harvest order.
+    """
+    re_delta_filename = re.compile(r'records_%s_from_(?P<from_date>[\d-]+)_0+\.xml(\.gz|\.zst)?$' % re.escape(metadata_prefix))
+    delta_dates = []
+    for filename in os.listdir(metadata_dir):
+        m = re_delta_filename.match(filename)
+        if m is not None:
+            delta_dates.append(m.group('from_date'))
+    return sorted(delta_dates)
+
+
+def iterate_metadata_files(metadata_dir, metadata_prefix, from_date=None):
     next_metadata_file_id = 0
     while True:
-        filename = os.path.join(
-            metadata_dir, 
-            'records_arXiv_%.10d.xml' % next_metadata_file_id,
-        )
+        filename = find_metadata_file(os.path.join(
+            metadata_dir,
+            metadata_output_file_name(metadata_prefix, next_metadata_file_id, from_date),
+        ))
 
-        if not os.path.exists(filename):
+        if filename is None:
             break
 
-        logger.info('Processing %s' % filename)
+        yield filename
+        next_metadata_file_id += 1
 
-        tree = etree.parse(filename)
-        record_elements = tree\
-            .getroot()\
-            .find('{http://www.openarchives.org/OAI/2.0/}ListRecords')\
-            .findall('{http://www.openarchives.org/OAI/2.0/}record')
 
-        metadata_objects = []
-        for record_element in record_elements:
-            obj = parse_metadata_arXiv(record_element)
-            if obj is not None:
-                obj['_id'] = obj.pop('arxiv_id')
-                metadata_objects.append(obj)
-            else:
-                record_xml = etree.tostring(record_element)
-                logger.error(
-                    'Cannot parse metadata record'
-                    'in {filename}: {record_xml}'.format(**locals())
-                )
+def iterate_metadata_records(filename, parse_record):
+    """
+    Stream records of OAI ListRecords page through parse_record one by one.
 
-        metadata_collection.insert_many(metadata_objects)
-        logger.info('Inserted %d records' % len(metadata_objects))
+    Processed elements are cleared, so memory does not grow with page size.
+    Records which cannot be parsed are logged and skipped. Compressed pages
+    are decompressed on the fly.
+    """
+    metadata_file = open_metadata_file(filename)
+    context = etree.iterparse(
+        metadata_file,
+        events=('end',),
+        tag='{http://www.openarchives.org/OAI/2.0/}record',
+    )
+    for _, record_element in context:
+        obj = parse_record(record_element)
+        if obj is not None:
+            yield obj
+        else:
+            record_xml = etree.tostring(record_element)
+            logger.error(
+                'Cannot parse metadata record '
+                'in {filename}: {record_xml}'.format(**locals())
+            )
 
-        next_metadata_file_id += 1
+        record_element.clear()
+        while record_element.getprevious() is not None:
+            del record_element.getparent()[0]
+    del context
+    metadata_file.close()
 
-    """    
-    logger.info('Start reading arXivRaw metadata')
-    
-    next_metadata_file_id = 0
-    while True:
-        filename = os.path.join(
-            metadata_dir, 
-            'records_arXivRaw_%.10d.xml' % next_metadata_file_id,
+
+metadata_parsers = {
+    'arXiv': parse_metadata_arXiv,
+    'arXivRaw': parse_metadata_arXivRaw,
+}
+
+
+def parse_metadata_file(task):
+    filename, metadata_prefix = task
+    return list(iterate_metadata_records(filename, metadata_parsers[metadata_prefix]))
+
+
+def iterate_parsed_metadata_files(metadata_dir, metadata_prefix, workers=1, from_date=None):
+    """
+    Yield (filename, records) pairs for all pages of metadata_prefix in file order.
+
+    With workers > 1 pages are parsed in a process pool, keeping at most
+    2 * workers parsed pages in flight so a slow writer does not pile them up.
+    """
+    filenames = iterate_metadata_files(metadata_dir, metadata_prefix, from_date)
+
+    if workers <= 1:
+        for filename in filenames:
+            yield filename, iterate_metadata_records(filename, metadata_parsers[metadata_prefix])
+        return
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = collections.deque()
+        for filename in filenames:
+            pending.append((filename, pool.apply_async(parse_metadata_file, [(filename, metadata_prefix)])))
+            if len(pending) >= 2 * workers:
+                filename, result = pending.popleft()
+                yield filename, result.get()
+        while pending:
+            filename, result = pending.popleft()
+            yield filename, result.get()
+    finally:
+        pool.terminate()
+
+
+def update_metadata_batch(metadata_collection, update_requests):
+    result = metadata_collection.bulk_write(update_requests, ordered=False)
+    n_missing = len(update_requests) - result.matched_count
+    logger.info(
+        'Updated batch of %d records: matched %d, modified %d, missing %d' % (
+            len(update_requests), result.matched_count, result.modified_count, n_missing,
         )
+    )
+    return result.matched_count, result.modified_count, n_missing
 
-        if not os.path.exists(filename):
-            break
 
+def update_metadata(metadata_collection, update_requests, batch_size):
+    """
+    Apply UpdateOne requests in unordered bulk batches, return total counters.
+    """
+    counters = [0, 0, 0]
+    batch = []
+    for update_request in update_requests:
+        batch.append(update_request)
+        if len(batch) >= batch_size:
+            batch_counters = update_metadata_batch(metadata_collection, batch)
+            counters = [a + b for a, b in zip(counters, batch_counters)]
+            batch = []
+
+    if batch:
+        batch_counters = update_metadata_batch(metadata_collection, batch)
+        counters = [a + b for a, b in zip(counters, batch_counters)]
+    return counters
+
+
+def collect_metadata_arXiv(metadata_collection, metadata_dir, batch_size=1000, workers=1, from_date=None):
+    """
+    Insert records from arXiv pages. Pages of incremental harvest (from_date)
+    are upserted, keeping fields merged from arXivRaw and sources.
+    """
+    if from_date is not None:
+        logger.info('Start upserting arXiv metadata changed since %s' % from_date)
+
+        def iterate_update_requests():
+            parsed_files = iterate_parsed_metadata_files(metadata_dir, 'arXiv', workers, from_date)
+            for filename, records in parsed_files:
+                logger.info('Processing %s' % filename)
+                for obj in records:
+                    arxiv_id = obj.pop('arxiv_id')
+                    yield pymongo.UpdateOne({'_id': arxiv_id}, {'$set': obj}, upsert=True)
+
+        counters = update_metadata(metadata_collection, iterate_update_requests(), batch_size)
+        logger.info('Finished arXiv metadata: matched %d, modified %d, inserted %d' % tuple(counters))
+        return
+
+    logger.info('Start reading arXiv metadata')
+
+    for filename, records in iterate_parsed_metadata_files(metadata_dir, 'arXiv', workers):
         logger.info('Processing %s' % filename)
 
-        tree = etree.parse(filename)
-        record_elements = tree\
-            .getroot()\
-            .find('{http://www.openarchives.org/OAI/2.0/}ListRecords')\
-            .findall('{http://www.openarchives.org/OAI/2.0/}record')
+        n_inserted = 0
+        metadata_objects = []
+        for obj in records:
+            obj['_id'] = obj.pop('arxiv_id')
+            metadata_objects.append(obj)
+            if len(metadata_objects) >= batch_size:
+                metadata_collection.insert_many(metadata_objects)
+                n_inserted += len(metadata_objects)
+                metadata_objects = []
+
+        if metadata_objects:
+            metadata_collection.insert_many(metadata_objects)
+            n_inserted += len(metadata_objects)
+        logger.info('Inserted %d records' % n_inserted)
+
 
-        for record_element in record_elements:
-            obj = parse_metadata_arXivRaw(record_element)
-            if obj is not None:
+def collect_metadata_arXivRaw(metadata_collection, metadata_dir, batch_size=1000, workers=1, from_date=None):
+    logger.info('Start reading arXivRaw metadata')
+
+    def iterate_update_requests():
+        parsed_files = iterate_parsed_metadata_files(metadata_dir, 'arXivRaw', workers, from_date)
+        for filename, records in parsed_files:
+            logger.info('Processing %s' % filename)
+            for obj in records:
                 arxiv_id = obj.pop('arxiv_id')
-                metadata_collection.update_one(
-                    {'_id': arxiv_id},
-                    {'$set': obj},
-                )
-            else:
-                record_xml = etree.tostring(record_element)
-                logger.error(
-                    'Cannot parse raw metadata record'
-                    'in {filename}: {record_xml}'.format(**locals())
-                )
+                yield pymongo.UpdateOne({'_id': arxiv_id}, {'$set': obj})
 
-        next_metadata_file_id += 1
+    counters = update_metadata(metadata_collection, iterate_update_requests(), batch_size)
+    logger.info('Finished arXivRaw metadata: matched %d, modified %d, missing %d' % tuple(counters))
 
 
-def write_to_jsonlines_file(metadata_collection, jsonlines_file):  
+def collect_metadata(metadata_collection, metadata_dir, metadata_prefixes=('arXiv', 'arXivRaw'),
+                     batch_size=1000, workers=1, deltas=False, deltas_since=None):
+    """
+    Load harvested pages into collection. With deltas, apply incremental page
+    sequences (optionally only those started at deltas_since or later) in
+    order of their from-dates instead of the complete harvest.
+    """
+    if deltas:
+        from_dates = set()
+        for metadata_prefix in metadata_prefixes:
+            from_dates.update(list_delta_dates(metadata_dir, metadata_prefix))
+        from_dates = [
+            from_date for from_date in sorted(from_dates)
+            if deltas_since is None or from_date >= deltas_since
+        ]
+    else:
+        from_dates = [None]
+
+    for from_date in from_dates:
+        if 'arXiv' in metadata_prefixes:
+            collect_metadata_arXiv(metadata_collection, metadata_dir,
+                                   batch_size=batch_size, workers=workers, from_date=from_date)
+        if 'arXivRaw' in metadata_prefixes:
+            collect_metadata_arXivRaw(metadata_collection, metadata_dir,
+                                      batch_size=batch_size, workers=workers, from_date=from_date)
+
+
+def collect_metadata_to_store(store_dir, metadata_dir, metadata_prefixes=('arXiv', 'arXivRaw'), workers=1):
+    import arxiv_metadata_store
+
+    for metadata_prefix in ('arXiv', 'arXivRaw'):
+        if metadata_prefix not in metadata_prefixes:
+            continue
+        logger.info('Start reading %s metadata into %s' % (metadata_prefix, store_dir))
+
+        writer = arxiv_metadata_store.MetadataStoreWriter(store_dir, metadata_prefix)
+        for filename, records in iterate_parsed_metadata_files(metadata_dir, metadata_prefix, workers):
+            logger.info('Processing %s' % filename)
+            for obj in records:
+                obj['_id'] = obj.pop('arxiv_id')
+                writer.write(obj)
+        writer.close()
+        logger.info('Written %d %s records' % (writer.n_written, metadata_prefix))
+
+
+EXPORT_SORT_KEY = [('info.created', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]
+
+
+def open_jsonlines_file(filename, buffer_size=1024**2):
+    """
+    Open jsonlines output file, compressing on the fly for .gz and .bz2 names.
+    """
+    if filename == '-':
+        return sys.stdout
+    if filename.endswith('.gz'):
+        return gzip.GzipFile(fileobj=open(filename, 'wb', buffer_size), mode='wb')
+    if filename.endswith('.bz2'):
+        return bz2.BZ2File(filename, 'wb', buffer_size)
+    return open(filename, 'wb', buffer_size)
+
+
+def has_export_index(metadata_collection):
+    for index in metadata_collection.index_information().values():
+        if list(index['key']) == EXPORT_SORT_KEY:
+            return True
+    return False
+
+
+def iterate_sorted_with_index(metadata_collection):
+    return metadata_collection.find({}).sort(EXPORT_SORT_KEY).batch_size(1000)
+
+
+def iterate_sorted_externally(metadata_collection, encoder, chunk_size):
+    """
+    Yield encoded records ordered by (info.created, _id) using external merge sort.
+
+    The collection is scanned once; sorted runs of chunk_size records are
+    spilled to temporary files and merged lazily.
+    """
+    def dump_chunk(chunk):
+        chunk.sort()
+        chunk_file = tempfile.TemporaryFile()
+        for created, arxiv_id, line in chunk:
+            chunk_file.write('%s\t%s\t%s\n' % (created, arxiv_id, line))
+        chunk_file.seek(0)
+        return chunk_file
+
+    def read_chunk(chunk_file):
+        for line in chunk_file:
+            created, arxiv_id, line = line.rstrip('\n').split('\t', 2)
+            yield created, arxiv_id, line
+
+    chunk_files = []
+    chunk = []
+    for record in metadata_collection.find({}).batch_size(1000):
+        created = record.get('info', {}).get('created') or ''
+        chunk.append((created, record['_id'], encoder.encode(record)))
+        if len(chunk) >= chunk_size:
+            chunk_files.append(dump_chunk(chunk))
+            chunk = []
+    logger.info('Sorted %d chunks in temporary files' % len(chunk_files))
+
+    chunk.sort()
+    try:
+        runs = [read_chunk(chunk_file) for chunk_file in chunk_files] + [iter(chunk)]
+        for _, _, line in heapq.merge(*runs):
+            yield line
+    finally:
+        for chunk_file in chunk_files:
+            chunk_file.close()
+
+
+def write_to_jsonlines_file(metadata_collection, jsonlines_file, create_index=False, sort_chunk_size=100000):
     logger.info('Writing metadata to jsonlines file')
-    records = list(metadata_collection.find({}, {'_id': True, 'info.created': True}))
-    
-    logger.info('Sort records in jsonlines file by ???')
-    records.sort(key=lambda record: '%s %s' % (record['info']['created'], record['_id']))
-    
-    for n, record in enumerate(records):
-        metadata_record = metadata_collection.find_one(record['_id'])
-        jsonlines_file.write(json.dumps(metadata_record, separators=(',', ':')) + '\n')
-        if n % 1000 == 0 and n > 0:
+    encoder = json.JSONEncoder(separators=(',', ':'))
+
+    if create_index:
+        metadata_collection.create_index(EXPORT_SORT_KEY)
+
+    if has_export_index(metadata_collection):
+        logger.info('Sort records by info.created, _id using index')
+        lines = (encoder.encode(record) for record in iterate_sorted_with_index(metadata_collection))
+    else:
+        logger.info('No index on info.created, _id, sort records externally')
+        lines = iterate_sorted_externally(metadata_collection, encoder, sort_chunk_size)
+
+    for n, line in enumerate(lines):
+        jsonlines_file.write(line + '\n')
+        if n % 100000 == 0 and n > 0:
             logger.info('Writed %d records' % n)
     
         
@@ -221,9 +456,28 @@ if __name__ == '__main__':
     parser.add_argument('--db', default='mongodb://localhost:27017/arxiv')
     parser.add_argument('--drop-collection', default=False, action='store_true')
     parser.add_argument('--read-metadata-dir')
-    parser.add_argument('--write-jsonlines-file', type=argparse.FileType('w'))
+    parser.add_argument('--write-store-dir')
+    parser.add_argument('--read-deltas', default=False, action='store_true',
+                        help='upsert incremental page sequences instead of the complete harvest')
+    parser.add_argument('--deltas-since', help='only read incremental sequences started at YYYY-MM-DD or later')
+    parser.add_argument('--metadata-prefix', nargs='+', default=['arXiv', 'arXivRaw'],
+                        choices=['arXiv', 'arXivRaw'])
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--write-jsonlines-file')
+    parser.add_argument('--create-export-index', default=False, action='store_true')
+    parser.add_argument('--sort-chunk-size', type=int, default=100000)
     args = parser.parse_args()
     
+    if args.write_store_dir:
+        collect_metadata_to_store(
+            args.write_store_dir,
+            metadata_dir=args.read_metadata_dir,
+            metadata_prefixes=args.metadata_prefix,
+            workers=args.workers,
+        )
+        sys.exit(0)
+
     client = pymongo.MongoClient(args.db)
     db_uri_parts = pymongo.uri_parser.parse_uri(args.db)
     db_name = db_uri_parts['database']
@@ -238,10 +492,19 @@ if __name__ == '__main__':
         collect_metadata(
             metadata_collection,
             metadata_dir=args.read_metadata_dir,
+            metadata_prefixes=args.metadata_prefix,
+            batch_size=args.batch_size,
+            workers=args.workers,
+            deltas=args.read_deltas,
+            deltas_since=args.deltas_since,
         )
     
     if args.write_jsonlines_file:
+        jsonlines_file = open_jsonlines_file(args.write_jsonlines_file)
         write_to_jsonlines_file(
             metadata_collection,
-            args.write_jsonlines_file,
+            jsonlines_file,
+            create_index=args.create_export_index,
+            sort_chunk_size=args.sort_chunk_size,
         )
+        jsonlines_file.close()
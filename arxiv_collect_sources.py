@@ -1,18 +1,27 @@
 #!/usr/bin/env python
 
+import io
 import os
 import re
+import sys
+import zlib
 import time
 import datetime
 import logging
 import argparse
 import tarfile
+import collections
+import multiprocessing
 
+import pymongo
 from lxml import etree
 
+from arxiv_collect_metadata import update_metadata
+
 __all__ = [
     'read_manifest',
     'read_archives',
+    'SourceReader',
 ]
 
 
@@ -29,131 +38,309 @@ def read_manifest(manifest_filename):
         yield file_info
 
 
-        
-re_item_filename_old = re.compile('(?P<partition>[^\d]+)(?P<id>\d+).(?P<ext>[^.]+)')
-re_item_filename_new = re.compile('(?P<id>\d\d\d\d.\d+).(?P<ext>[^.]+)')
+re_item_filename_old = re.compile(r'(?P<partition>[^\d]+)(?P<id>\d+).(?P<ext>[^.]+)')
+re_item_filename_new = re.compile(r'(?P<id>\d\d\d\d.\d+).(?P<ext>[^.]+)')
 
 def parse_archive_item_filename(filename):
     m_old = re_item_filename_old.match(filename)
-    m_new = re_item_filename_new.match(filename)
-
     if m_old is not None:
         arxiv_id = m_old.group('partition') + '/' + m_old.group('id')
         ext = m_old.group('ext')
         return arxiv_id, ext
-     elif m_new is not None:
+
+    m_new = re_item_filename_new.match(filename)
+    if m_new is not None:
         arxiv_id = m_new.group('id')
         ext = m_new.group('ext')
         return arxiv_id, ext
 
-        
-def read_archives(manifest_filename, data_path):
-    total_items = 0
-    missing_items = 0
+
+def iterate_tar_members(archive_filename):
+    """
+    Yield members of uncompressed tar reading only their headers: data of
+    members is skipped by seeking, and members are not accumulated.
+    """
+    with tarfile.open(archive_filename, mode='r:') as tf:
+        while True:
+            member = tf.next()
+            if member is None:
+                break
+            tf.members = []
+            yield member
+
+
+def index_archive(task):
+    """
+    List items of source archive as dicts with arXiv id, ext, path inside
+    the archive and offset and size of the item data.
+    """
+    archive_filename, archive_name = task
     item_records = []
-    
+    for member in iterate_tar_members(archive_filename):
+        if not member.isfile():
+            continue
+        parsed = parse_archive_item_filename(os.path.split(member.name)[1])
+        if parsed is None:
+            continue
+        arxiv_id, ext = parsed
+        item_records.append({
+            'id': arxiv_id,
+            'ext': ext,
+            'archive': archive_name,
+            'path': member.name,
+            'offset': member.offset_data,
+            'size': member.size,
+        })
+    return archive_name, item_records
+
+
+def read_archives(manifest_filename, data_path, workers=1):
+    """
+    Index source archives listed in manifest, in a pool of processes.
+    Yields (file_info, item_records) as archives are done.
+    """
+    file_infos = {}
+    tasks = []
     for file_info in read_manifest(manifest_filename):
         archive_filename = os.path.join(data_path, file_info['filename'])
-        
         if not os.path.exists(archive_filename):
             logger.info('%s: - n/a -' % archive_filename)
             continue
+        file_infos[file_info['filename']] = file_info
+        tasks.append((archive_filename, file_info['filename']))
 
-        
-def load_arxiv_items(arxiv_path='/home/romovpa/arxiv/', metadata_collection=None):
-    total_items = 0
-    missing_items = 0
-    item_records = []
+    if workers <= 1:
+        for task in tasks:
+            archive_name, item_records = index_archive(task)
+            yield file_infos[archive_name], item_records
+        return
 
-    re_item_filename_old = re.compile('(?P<partition>[^\d]+)(?P<id>\d+).(?P<ext>[^.]+)')
-    re_item_filename_new = re.compile('(?P<id>\d\d\d\d.\d+).(?P<ext>[^.]+)')
+    pool = multiprocessing.Pool(workers)
+    try:
+        for archive_name, item_records in pool.imap_unordered(index_archive, tasks):
+            yield file_infos[archive_name], item_records
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
 
-    for file_info in read_manifest(os.path.join(arxiv_path, 'arXiv_src_manifest.xml')):
-        archive_filename = os.path.join(arxiv_path, file_info['filename'])
 
-        if not os.path.exists(archive_filename):
-            print '%s: - n/a -' % archive_filename
-            continue
+def write_index_records(index_file, item_records):
+    for item_record in item_records:
+        index_file.write('%s\t%s\t%d\t%d\t%s\n' % (
+            item_record['id'], item_record['archive'], item_record['offset'], item_record['size'],
+            item_record['path'],
+        ))
+
+
+def collect_sources(metadata_collection, data_path, index_filename=None, workers=1, batch_size=1000):
+    """
+    Record locations of item sources from archives of data_path in
+    content.src of metadata and, if index_filename is given, in a TSV file
+    of arXiv id, archive, offset, size and path. Returns number of items
+    missing in archives according to the manifest.
+    """
+    total_items = 0
+    missing_items = 0
+    index_file = open(index_filename, 'w') if index_filename is not None else None
+
+    def iterate_update_requests(item_records):
+        for item_record in item_records:
+            yield pymongo.UpdateOne(
+                {'_id': item_record['id']},
+                {'$set': {
+                    'content.src': {
+                        'archive': item_record['archive'],
+                        'path': item_record['path'],
+                        'offset': item_record['offset'],
+                        'size': item_record['size'],
+                        'ext': item_record['ext'],
+                    }
+                }},
+            )
 
+    manifest_filename = os.path.join(data_path, 'arXiv_src_manifest.xml')
+    for file_info, item_records in read_archives(manifest_filename, data_path, workers):
+        archive_filename = os.path.join(data_path, file_info['filename'])
         cur_total_items = int(file_info['num_items'])
-        cur_processed_items = 0
-
-        arch = tarfile.open(archive_filename)
-        for member in arch.getmembers():
-            if member.isfile:
-                item_file_name = os.path.split(member.name)[1]
-
-                m_old = re_item_filename_old.match(item_file_name)
-                m_new = re_item_filename_new.match(item_file_name)
-                item_record = None
-                
-                if m_old is not None:
-                    item_record = {
-                            'partition': m_old.group('partition'),
-                            'id': m_old.group('partition') + '/' + m_old.group('id'),
-                            'ext': m_old.group('ext'),
-                            'source': file_info['filename'],
-                            'month': (
-                                ('19' if file_info['yymm'].startswith('9') else '20') + file_info['yymm']
-                            ),
-                        }
-                elif m_new is not None:
-                    item_record = {
-                            'partition': None,
-                            'id': m_new.group('id'),
-                            'ext': m_new.group('ext'),
-                            'source': file_info['filename'],
-                            'month': (
-                                ('19' if file_info['yymm'].startswith('9') else '20') + file_info['yymm']
-                            ),
-                        }
-                
-                if item_record is not None:
-                    item_records.append(item_record)
-                    cur_processed_items += 1
-                    
-                    if metadata_collection is not None:
-                        metadata_collection.update_one(
-                            {'_id': item_record['id']},
-                            {'$set': {
-                                    'content.src': {
-                                        'archive': file_info['filename'],
-                                        'path': member.name,
-                                        'size': member.size,
-                                        'ext': item_record['ext'],
-                                    }
-                                }},
-                        )
+        cur_processed_items = len(item_records)
+
+        if metadata_collection is not None and item_records:
+            update_metadata(metadata_collection, iterate_update_requests(item_records), batch_size)
+        if index_file is not None:
+            write_index_records(index_file, item_records)
 
         total_items += cur_total_items
-        missing_items += cur_total_items - cur_processed_items
+        missing_items += max(cur_total_items - cur_processed_items, 0)
 
         if cur_processed_items < cur_total_items:
-            print '%s: MISSING %d' % (archive_filename, cur_total_items-cur_processed_items)
+            logger.info('%s: MISSING %d' % (archive_filename, cur_total_items - cur_processed_items))
         elif cur_processed_items > cur_total_items:
-            print '%s: EXTRA %d' % (archive_filename, cur_processed_items-cur_total_items)
+            logger.info('%s: EXTRA %d' % (archive_filename, cur_processed_items - cur_total_items))
         else:
-            print '%s: ok' % archive_filename
+            logger.info('%s: ok' % archive_filename)
+
+    if index_file is not None:
+        index_file.close()
+
+    logger.info('Missing documents: %d of %d' % (missing_items, total_items))
+    return missing_items
+
+
+def read_index_file(index_filename):
+    locations = {}
+    with open(index_filename) as index_file:
+        for line in index_file:
+            arxiv_id, archive, offset, size, path = line.rstrip('\n').split('\t')
+            locations[arxiv_id] = {'archive': archive, 'offset': int(offset), 'size': int(size), 'path': path}
+    return locations
+
+
+def unpack_source(path, data):
+    """
+    Return dict of file name -> contents of item source: files of gzipped
+    tar, single gzipped file (named as the item without .gz) or the item
+    itself, e.g. a PDF or a .gz item that is not gzipped.
+    """
+    item_name = os.path.split(path)[1]
+    if not item_name.endswith('.gz'):
+        return {item_name: data}
+    try:
+        with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as tf:
+            return dict(
+                (member.name, tf.extractfile(member).read())
+                for member in tf
+                if member.isfile()
+            )
+    except tarfile.ReadError:
+        pass
+    try:
+        return {item_name[:-len('.gz')]: zlib.decompress(data, 16 + zlib.MAX_WBITS)}
+    except zlib.error:
+        logger.warning('%s: not gzipped, returned as is' % path)
+        return {item_name: data}
+
+
+class SourceReader(object):
+    """
+    Random access to item sources in archives of data_path by arXiv id.
+
+    Locations (archive, data offset and size) are taken from index file
+    written by collect_sources or from content.src in metadata collection.
+    Item data is read with one seek; up to max_open_archives archives are
+    kept open, least recently used are closed first.
+    """
+
+    def __init__(self, data_path, index_filename=None, metadata_collection=None, max_open_archives=16):
+        self.data_path = data_path
+        self.metadata_collection = metadata_collection
+        self.locations = read_index_file(index_filename) if index_filename is not None else None
+        self.max_open_archives = max_open_archives
+        self.archive_files = collections.OrderedDict()
+
+    def locate(self, arxiv_id):
+        if self.locations is not None:
+            return self.locations.get(arxiv_id)
+        item = self.metadata_collection.find_one({'_id': arxiv_id}, {'content.src': True})
+        if item is not None and 'offset' in item.get('content', {}).get('src', {}):
+            return item['content']['src']
+
+    def archive_file(self, archive):
+        archive_file = self.archive_files.pop(archive, None)
+        if archive_file is None:
+            archive_file = open(os.path.join(self.data_path, archive), 'rb')
+            if len(self.archive_files) >= self.max_open_archives:
+                _, evicted_file = self.archive_files.popitem(last=False)
+                evicted_file.close()
+        self.archive_files[archive] = archive_file
+        return archive_file
+
+    def _read_source(self, location):
+        archive_file = self.archive_file(location['archive'])
+        archive_file.seek(location['offset'])
+        return archive_file.read(location['size'])
+
+    def get_source(self, arxiv_id):
+        """
+        Return item source as stored in archive (usually gzipped), or None.
+        """
+        location = self.locate(arxiv_id)
+        if location is None:
+            return None
+        return self._read_source(location)
+
+    def get_source_files(self, arxiv_id):
+        """
+        Return dict of file name -> contents of item source, or None.
+        """
+        location = self.locate(arxiv_id)
+        if location is None:
+            return None
+        return unpack_source(location['path'], self._read_source(location))
+
+    def close(self):
+        for archive_file in self.archive_files.values():
+            archive_file.close()
+        self.archive_files.clear()
 
 
-    print 'Missing documents: %d ' % missing_items
-    
-    return item_records
-        
-        
 if __name__ == '__main__':
     logging.basicConfig(
         format='[%(asctime)s] %(levelname)s %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S',
         level=logging.INFO,
     )
-    
+
     parser = argparse.ArgumentParser()
-    parser.add_argument('--data-dir', default='.')
+    parser.add_argument('--data-dir', default='.', help='directory with arXiv_src_manifest.xml and source archives')
     parser.add_argument('--metadata-dir', default='metadata')
     parser.add_argument('--db', default='mongodb://localhost:27017/arxiv')
+    parser.add_argument('--no-db', default=False, action='store_true', help='only write --index-file')
+    parser.add_argument('--index-file', help='write TSV of arXiv id, archive, offset, size and path')
+    parser.add_argument('--workers', type=int, default=1, help='archives indexed in parallel')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--get-source', nargs='+', metavar='ARXIV_ID',
+                        help='extract sources of these items to --output-dir instead of collecting')
+    parser.add_argument('--output-dir', default='.')
     args = parser.parse_args()
-    
+
     # source archives -> mongodb (basic info)
-    
-    
\ No newline at end of file
+    metadata_collection = None
+    if not args.no_db:
+        client = pymongo.MongoClient(args.db)
+        db_uri_parts = pymongo.uri_parser.parse_uri(args.db)
+        db_name = db_uri_parts['database']
+        collection_name = db_uri_parts['collection'] or 'metadata'
+        metadata_collection = client[db_name][collection_name]
+
+    if args.get_source is not None:
+        if args.index_file is None and metadata_collection is None:
+            parser.error('--get-source requires --index-file or database')
+        source_reader = SourceReader(args.data_dir, args.index_file, metadata_collection)
+        for arxiv_id in args.get_source:
+            source_files = source_reader.get_source_files(arxiv_id)
+            if source_files is None:
+                logger.error('%s: source not found' % arxiv_id)
+                continue
+            item_dir = os.path.join(args.output_dir, arxiv_id.replace('/', ''))
+            for filename, content in source_files.items():
+                filename = os.path.normpath(filename)
+                if os.path.isabs(filename) or filename.startswith('..'):
+                    logger.warning('%s: skipping file outside of item dir: %s' % (arxiv_id, filename))
+                    continue
+                path = os.path.join(item_dir, filename)
+                if not os.path.exists(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, 'wb') as f:
+                    f.write(content)
+            logger.info('%s: %d files extracted to %s' % (arxiv_id, len(source_files), item_dir))
+        source_reader.close()
+        sys.exit(0)
+
+    collect_sources(
+        metadata_collection,
+        args.data_dir,
+        index_filename=args.index_file,
+        workers=args.workers,
+        batch_size=args.batch_size,
+    )
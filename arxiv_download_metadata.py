@@ -1,10 +1,18 @@
 #!/usr/bin/env python
 
+import io
 import os
 import time
 import datetime
 import logging
 import argparse
+import json
+import gzip
+import threading
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
 
 import requests
 from lxml import etree
@@ -12,10 +20,8 @@ from lxml import etree
 logger = logging.getLogger(__name__)
 
 
-def read_metadata_resumption_token(filename):
-    tree = etree.parse(filename)
-    resumption_token_element = tree\
-        .getroot()\
+def parse_resumption_token(root_element):
+    resumption_token_element = root_element\
         .find('{http://www.openarchives.org/OAI/2.0/}ListRecords')\
         .find('{http://www.openarchives.org/OAI/2.0/}resumptionToken')
 
@@ -27,74 +33,286 @@ def read_metadata_resumption_token(filename):
     return token, cursor, complete_list_size
 
 
-def metadata_output_file_name(metadata_prefix, id):
+def read_metadata_resumption_token(filename):
+    with open_metadata_file(filename) as f:
+        tree = etree.parse(f)
+    return parse_resumption_token(tree.getroot())
+
+
+def read_oai_error(root_element):
+    error_element = root_element.find('{http://www.openarchives.org/OAI/2.0/}error')
+    if error_element is not None:
+        return error_element.attrib.get('code'), error_element.text
+
+
+def max_page_datestamp(root_element):
+    datestamps = [
+        datestamp_element.text
+        for datestamp_element in root_element.iterfind(
+            '{http://www.openarchives.org/OAI/2.0/}ListRecords'
+            '/{http://www.openarchives.org/OAI/2.0/}record'
+            '/{http://www.openarchives.org/OAI/2.0/}header'
+            '/{http://www.openarchives.org/OAI/2.0/}datestamp'
+        )
+    ]
+    return max(datestamps) if datestamps else None
+
+
+def metadata_output_file_name(metadata_prefix, id, from_date=None):
+    if from_date is not None:
+        return 'records_%s_from_%s_%.10d.xml' % (metadata_prefix, from_date, id)
     return 'records_%s_%.10d.xml' % (metadata_prefix, id)
-    
 
-def download_arxiv_metadata(metadata_files_path, oai_url, metadata_prefix, sleep_seconds):
+
+COMPRESSION_SUFFIXES = {
+    None: '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+
+def find_metadata_file(filename):
+    """
+    Return name of existing page file, uncompressed or compressed, or None.
+    """
+    for suffix in ('', '.gz', '.zst'):
+        if os.path.exists(filename + suffix):
+            return filename + suffix
+
+
+def open_metadata_file(filename):
+    """
+    Open page file for reading, decompressing .gz and .zst transparently.
+    """
+    if filename.endswith('.gz'):
+        return gzip.GzipFile(filename, 'rb')
+    if filename.endswith('.zst'):
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'))
+    return open(filename, 'rb')
+
+
+def compress_content(content, compression):
+    if compression == 'gzip':
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+            f.write(content)
+        return buf.getvalue()
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=10).compress(content)
+    return content
+
+
+def harvest_state_file_name(metadata_prefix):
+    return 'harvest_state_%s.json' % metadata_prefix
+
+
+def read_harvest_state(metadata_files_path, metadata_prefix):
+    state_file = os.path.join(metadata_files_path, harvest_state_file_name(metadata_prefix))
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file) as f:
+        return json.load(f)
+
+
+def write_harvest_state(metadata_files_path, metadata_prefix, state):
+    state_file = os.path.join(metadata_files_path, harvest_state_file_name(metadata_prefix))
+    with open(state_file + '.part', 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.rename(state_file + '.part', state_file)
+
+
+def delta_sequence_label(metadata_files_path, metadata_prefix, from_date, state):
+    """
+    Choose the name of the page sequence harvested from from_date.
+
+    An unfinished sequence of the same from_date is resumed. Pages of a
+    finished sequence are never reused for a new harvest (OAI from is
+    inclusive, so the high-water mark may not move between runs): a new
+    sequence is then named by from_date and the current time.
+    """
+    unfinished = state.get('unfinished_sequence')
+    if unfinished is not None and unfinished['from_date'] == from_date:
+        return unfinished['label']
+    first_page = os.path.join(metadata_files_path, metadata_output_file_name(metadata_prefix, 0, from_date))
+    if find_metadata_file(first_page) is None:
+        return from_date
+    return '%s-%s' % (from_date, datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S'))
+
+
+def retry_after_seconds(resp, default_seconds):
+    retry_after = resp.headers.get('Retry-After')
+    if retry_after is not None and retry_after.strip().isdigit():
+        return int(retry_after)
+    return default_seconds
+
+
+def write_metadata_files(write_queue, compression=None, errors=None):
+    """
+    Write downloaded pages from the queue until None is received.
+
+    Pages are written to a temporary name and renamed, so an interrupted
+    write never leaves a truncated page that would be skipped on restart.
+    If writing fails, the exception is appended to errors and the rest of
+    the queue is drained without writing, so put never blocks forever.
+    """
+    while True:
+        task = write_queue.get()
+        if task is None:
+            break
+        if errors:
+            continue
+        filename, content = task
+        filename += COMPRESSION_SUFFIXES[compression]
+        try:
+            with open(filename + '.part', 'wb') as f:
+                f.write(compress_content(content, compression))
+            os.rename(filename + '.part', filename)
+        except Exception as e:
+            logging.error('Cannot write %s: %s' % (filename, e))
+            if errors is not None:
+                errors.append(e)
+
+
+def create_session(pool_size=2):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def download_arxiv_metadata(metadata_files_path, oai_url, metadata_prefix, sleep_seconds, delay_seconds=0,
+                            from_date=None, until_date=None, compression=None):
+    """
+    Harvest ListRecords chain into numbered pages, skipping pages already on disk.
+
+    With from_date (and optionally until_date) only records changed since
+    that datestamp are requested and written to a separate page sequence
+    records_<prefix>_from_<label>_*.xml, see delta_sequence_label. The
+    sequence is marked unfinished in harvest_state_<prefix>.json until the
+    chain is complete; then the highest record datestamp seen is stored
+    there as the starting point for the next incremental run.
+
+    With compression ('gzip' or 'zstd') new pages are stored compressed;
+    pages already on disk are recognized in any of the formats.
+    """
     resumption_token = None
     next_metadata_file_id = 0
+    last_datestamp = None
+    finished = False
 
-    while next_metadata_file_id == 0 or resumption_token is not None:
-        
-        next_metadata_file = os.path.join(
-            metadata_files_path, 
-            metadata_output_file_name(metadata_prefix, next_metadata_file_id),
-        )
+    sequence_label = None
+    if from_date is not None:
+        state = read_harvest_state(metadata_files_path, metadata_prefix)
+        sequence_label = delta_sequence_label(metadata_files_path, metadata_prefix, from_date, state)
+        state['unfinished_sequence'] = {'from_date': from_date, 'label': sequence_label}
+        write_harvest_state(metadata_files_path, metadata_prefix, state)
+        logging.info('Harvesting records changed since %s to sequence %s' % (from_date, sequence_label))
 
-        if not os.path.exists(next_metadata_file):
-            params = {'verb': 'ListRecords'}
-            if resumption_token is None:
-                logging.info('Starting new OAI chain')
-                params['metadataPrefix'] = metadata_prefix
-            else:
-                params['resumptionToken'] = resumption_token
-
-            try:
-                resp = requests.get(oai_url, params=params, timeout=100)
-            except KeyboardInterrupt:
-                logging.error('Keyboard interrupt, stopping')
-                return
-            except requests.exceptions.Timeout:
-                logging.error('Timeout, trying again')
-                continue
-            except requests.exceptions.ConnectionError as e:
-                logging.error('Connection error: %s' % e.message)
-                logging.error('Trying again')
-                continue
-            except Exception as e:
-                logging.error('Exception: %s' % str(e))
-                logging.error('Trying again')
-                continue
-                
-
-            if not resp.ok:
-                now = datetime.datetime.now()
-                logging.error('HTTP status %d, sleeping' % resp.status_code)
-                time.sleep(sleep_seconds)
-                continue
-
-            with open(next_metadata_file, 'w') as f:
-                f.write(resp.content)
-
-                
-            resumption_token, cursor, complete_list_size = read_metadata_resumption_token(next_metadata_file)
-
-            logging.info(
-                'Downloaded {next_metadata_file}: cursor={cursor}, size={complete_list_size}, token={resumption_token}'.format(**locals())
+    session = create_session()
+    write_queue = Queue.Queue(maxsize=4)
+    writer_errors = []
+    writer_thread = threading.Thread(target=write_metadata_files, args=(write_queue, compression, writer_errors))
+    writer_thread.start()
+
+    try:
+        while next_metadata_file_id == 0 or resumption_token is not None:
+
+            next_metadata_file = os.path.join(
+                metadata_files_path,
+                metadata_output_file_name(metadata_prefix, next_metadata_file_id, sequence_label),
             )
-            
-            time.sleep(sleep_seconds)
-            
+
+            existing_metadata_file = find_metadata_file(next_metadata_file)
+            if existing_metadata_file is None:
+                params = {'verb': 'ListRecords'}
+                if resumption_token is None:
+                    logging.info('Starting new OAI chain')
+                    params['metadataPrefix'] = metadata_prefix
+                    if from_date is not None:
+                        params['from'] = from_date
+                    if until_date is not None:
+                        params['until'] = until_date
+                else:
+                    params['resumptionToken'] = resumption_token
+
+                try:
+                    resp = session.get(oai_url, params=params, timeout=100)
+                except KeyboardInterrupt:
+                    logging.error('Keyboard interrupt, stopping')
+                    return
+                except requests.exceptions.Timeout:
+                    logging.error('Timeout, trying again')
+                    continue
+                except requests.exceptions.ConnectionError as e:
+                    logging.error('Connection error: %s' % e)
+                    logging.error('Trying again')
+                    continue
+                except Exception as e:
+                    logging.error('Exception: %s' % str(e))
+                    logging.error('Trying again')
+                    continue
+
+                if not resp.ok:
+                    retry_seconds = retry_after_seconds(resp, sleep_seconds)
+                    logging.error('HTTP status %d, sleeping %d seconds' % (resp.status_code, retry_seconds))
+                    time.sleep(retry_seconds)
+                    continue
+
+                root_element = etree.fromstring(resp.content)
+                oai_error = read_oai_error(root_element)
+                if oai_error is not None:
+                    if oai_error[0] == 'noRecordsMatch':
+                        logging.info('No records changed since %s' % from_date)
+                        finished = True
+                        break
+                    raise RuntimeError('OAI error %s: %s' % oai_error)
+
+                resumption_token, cursor, complete_list_size = parse_resumption_token(root_element)
+                if writer_errors:
+                    raise writer_errors[0]
+                write_queue.put((next_metadata_file, resp.content))
+
+                logging.info(
+                    'Downloaded {next_metadata_file}: cursor={cursor}, size={complete_list_size}, token={resumption_token}'.format(**locals())
+                )
+
+                if delay_seconds > 0:
+                    time.sleep(delay_seconds)
+
+            else:
+                logging.info('Skip {existing_metadata_file}'.format(**locals()))
+                with open_metadata_file(existing_metadata_file) as f:
+                    root_element = etree.parse(f).getroot()
+                resumption_token, cursor, complete_list_size = parse_resumption_token(root_element)
+
+            page_datestamp = max_page_datestamp(root_element)
+            if page_datestamp is not None and (last_datestamp is None or page_datestamp > last_datestamp):
+                last_datestamp = page_datestamp
+            next_metadata_file_id += 1
+
         else:
-            logging.info('Skip {next_metadata_file}'.format(**locals()))
-            resumption_token, cursor, complete_list_size = read_metadata_resumption_token(next_metadata_file)
+            finished = True
+
+    finally:
+        write_queue.put(None)
+        writer_thread.join()
+
+    if writer_errors:
+        raise writer_errors[0]
 
-        next_metadata_file_id += 1
-        
-    if next_metadata_file_id > 0 and resumption_token is None:
+    if finished:
         logging.info('Empty resumptionToken, we are finished!')
 
+        state = read_harvest_state(metadata_files_path, metadata_prefix)
+        state.pop('unfinished_sequence', None)
+        if last_datestamp is not None and last_datestamp > state.get('last_datestamp', ''):
+            state['last_datestamp'] = last_datestamp
+            logging.info('Harvested records up to datestamp %s' % last_datestamp)
+        write_harvest_state(metadata_files_path, metadata_prefix, state)
+
 
 if __name__ == '__main__':
     logging.basicConfig(
@@ -104,15 +322,37 @@ if __name__ == '__main__':
     )
     
     parser = argparse.ArgumentParser()
-    parser.add_argument('--sleep', default=25)
+    parser.add_argument('--sleep', type=int, default=25,
+                        help='seconds to wait after HTTP error without Retry-After')
+    parser.add_argument('--delay', type=float, default=25,
+                        help='seconds to wait between successful requests (0 only for a local OAI server)')
     parser.add_argument('--oai-url', default='http://export.arxiv.org/oai2')
     parser.add_argument('--metadata-prefix', default='arXiv')
     parser.add_argument('--output-dir', default='metadata')
+    parser.add_argument('--incremental', default=False, action='store_true',
+                        help='harvest only records changed since the last complete harvest')
+    parser.add_argument('--from-date', help='harvest only records changed since YYYY-MM-DD')
+    parser.add_argument('--until-date', help='harvest only records changed until YYYY-MM-DD')
+    parser.add_argument('--compression', choices=['gzip', 'zstd'],
+                        help='store pages compressed (zstd requires zstandard package)')
     args = parser.parse_args()
 
+    metadata_files_path = os.path.abspath(args.output_dir)
+
+    from_date = args.from_date
+    if args.incremental and from_date is None:
+        state = read_harvest_state(metadata_files_path, args.metadata_prefix)
+        if 'last_datestamp' not in state:
+            parser.error('No harvest state in %s, run a complete harvest first' % metadata_files_path)
+        from_date = state['last_datestamp']
+
     download_arxiv_metadata(
-        metadata_files_path=os.path.abspath(args.output_dir),
+        metadata_files_path=metadata_files_path,
         oai_url=args.oai_url,
         metadata_prefix=args.metadata_prefix,
         sleep_seconds=args.sleep,
+        delay_seconds=args.delay,
+        from_date=from_date,
+        until_date=args.until_date,
+        compression=args.compression,
     )
\ No newline at end of file
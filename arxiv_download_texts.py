@@ -5,6 +5,10 @@ Create plain text dataset of arXiv papers, using PDF archives.
 Requirements:
   - pip install boto requests lxml
   - apt-get install poppler-utils
+
+Archives are taken from the requester-pays arxiv S3 bucket, or from a local
+directory mirroring its layout (--source-dir), or from an S3-compatible
+stand-in such as moto_server (--s3-host, --s3-port).
 """
 
 import os
@@ -12,13 +16,19 @@ import sys
 import shutil
 import tarfile
 import tempfile
+import sqlite3
 import time
 import datetime
 import logging
 import argparse
+import threading
 import subprocess
+from multiprocessing.pool import ThreadPool
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
 
-import boto
 import requests
 from lxml import etree
 
@@ -69,6 +79,335 @@ def filter_archives(manifest_records, start_month, finish_month):
     return filtered_records
 
 
+def run_pdftotext(pdf_path, txt_path, timeout=None, pdf_data=None):
+    """
+    Convert one PDF, killing pdftotext if it runs longer than timeout seconds.
+    If pdf_data is given, it is piped to pdftotext stdin instead of reading pdf_path.
+
+    Returns None on success or error description.
+    """
+    cmd = ['pdftotext', '-enc', 'UTF-8', '-' if pdf_data is not None else pdf_path, txt_path]
+    logger.debug('Running pdftotext: ' + str(cmd))
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE if pdf_data is not None else None)
+
+    timed_out = []
+    def kill():
+        # the process may have exited just before the timer fired
+        if proc.poll() is None:
+            timed_out.append(True)
+            proc.kill()
+
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+    try:
+        if pdf_data is not None:
+            try:
+                proc.communicate(pdf_data)
+            except IOError:
+                # pdftotext exited before reading all input
+                pass
+        returncode = proc.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+
+    if timed_out:
+        return 'timeout after %d seconds' % timeout
+    if returncode != 0:
+        return 'pdftotext exit status %d' % returncode
+
+
+def convert_pdfs(pdf_tasks, jobs=1, timeout=None):
+    """
+    Convert PDF tasks in a pool of jobs threads, each running its own
+    pdftotext process. Yields (task, error) as conversions finish.
+
+    Task is a dict with pdf_name, txt_path and either pdf_path or pdf_data.
+    At most 2 * jobs tasks are taken from pdf_tasks ahead of conversion, so
+    tasks carrying PDF contents do not pile up in memory.
+    """
+    slots = threading.BoundedSemaphore(2 * jobs)
+
+    def iterate_tasks():
+        for task in pdf_tasks:
+            slots.acquire()
+            yield task
+
+    def convert(task):
+        start_time = time.time()
+        try:
+            return task, run_pdftotext(task['pdf_path'], task['txt_path'], timeout, task.get('pdf_data'))
+        finally:
+            task['duration'] = time.time() - start_time
+            slots.release()
+
+    pool = ThreadPool(jobs)
+    try:
+        for task, error in pool.imap_unordered(convert, iterate_tasks()):
+            yield task, error
+    finally:
+        pool.close()
+        pool.join()
+
+
+def pdf_name_of_member(member):
+    _, member_name = os.path.split(member.name)
+    if member.isfile() and member_name.endswith('.pdf'):
+        pdf_name, _ = os.path.splitext(member_name)
+        return pdf_name
+
+
+def iterate_extracted_pdf_tasks(archive_local_path, tmp_dir, txt_dir, skip_pdf_names=()):
+    with tarfile.open(archive_local_path) as tf:
+        pdf_members = []
+        for member in tf.getmembers():
+            pdf_name = pdf_name_of_member(member)
+            if pdf_name is not None and pdf_name not in skip_pdf_names:
+                pdf_members.append((pdf_name, member))
+        tf.extractall(tmp_dir, members=[member for _, member in pdf_members])
+        for pdf_name, member in pdf_members:
+            yield {
+                'pdf_name': pdf_name,
+                'pdf_path': os.path.join(tmp_dir, member.name),
+                'txt_path': os.path.join(txt_dir, pdf_name + '.txt'),
+            }
+
+
+def iterate_streamed_pdf_tasks(archive_local_path, txt_dir, skip_pdf_names=()):
+    """
+    Read PDFs from the archive in a single sequential pass, without
+    extracting it to disk. Task carries PDF contents in pdf_data.
+    """
+    with tarfile.open(archive_local_path, mode='r|*') as tf:
+        for member in tf:
+            pdf_name = pdf_name_of_member(member)
+            if pdf_name is not None and pdf_name not in skip_pdf_names:
+                yield {
+                    'pdf_name': pdf_name,
+                    'pdf_path': member.name,
+                    'pdf_data': tf.extractfile(member).read(),
+                    'txt_path': os.path.join(txt_dir, pdf_name + '.txt'),
+                }
+
+
+def save_error_pdf(task, error_pdf_dir):
+    if task.get('pdf_data') is not None:
+        with open(os.path.join(error_pdf_dir, task['pdf_name'] + '.pdf'), 'wb') as f:
+            f.write(task['pdf_data'])
+    else:
+        shutil.copy(task['pdf_path'], error_pdf_dir)
+
+
+class ConversionLedger(object):
+    """
+    Persistent record of finished conversions, so an interrupted run can be
+    resumed without converting the same PDFs again.
+
+    Every PDF is recorded with status 'ok' or 'failed', size of the text
+    file and conversion time; an archive is recorded when all its PDFs are
+    done. Failed PDFs are not retried on restart.
+    """
+
+    def __init__(self, filename, commit_every=100):
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS pdfs ('
+            ' archive TEXT, pdf_name TEXT, status TEXT, txt_size INTEGER,'
+            ' duration REAL, error TEXT, PRIMARY KEY (archive, pdf_name))'
+        )
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS archives ('
+            ' archive TEXT PRIMARY KEY, n_pdfs INTEGER, n_failed INTEGER, finished TEXT)'
+        )
+        self.connection.commit()
+        self.commit_every = commit_every
+        self.n_uncommitted = 0
+
+    def is_archive_done(self, archive_name):
+        cursor = self.connection.execute('SELECT 1 FROM archives WHERE archive = ?', (archive_name,))
+        return cursor.fetchone() is not None
+
+    def done_pdf_names(self, archive_name):
+        cursor = self.connection.execute('SELECT pdf_name FROM pdfs WHERE archive = ?', (archive_name,))
+        return set(pdf_name for pdf_name, in cursor)
+
+    def record_pdf(self, archive_name, task, error):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO pdfs VALUES (?, ?, ?, ?, ?, ?)',
+            (archive_name, task['pdf_name'], 'ok' if error is None else 'failed',
+             task.get('txt_size'), task.get('duration'), error),
+        )
+        self.n_uncommitted += 1
+        if self.n_uncommitted >= self.commit_every:
+            self.commit()
+
+    def record_archive(self, archive_name):
+        n_pdfs, n_failed = self.connection.execute(
+            "SELECT COUNT(*), SUM(status = 'failed') FROM pdfs WHERE archive = ?", (archive_name,),
+        ).fetchone()
+        self.connection.execute(
+            'INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?)',
+            (archive_name, n_pdfs, n_failed or 0, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')),
+        )
+        self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.n_uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+def pack_text(task, text_store_writer):
+    with open(task['txt_path'], 'rb') as txt_file:
+        text_store_writer.write(task['pdf_name'], txt_file.read())
+    os.remove(task['txt_path'])
+
+
+def process_archive(archive_local_path, args, ledger=None, text_store_writer=None):
+    archive_name = os.path.split(archive_local_path)[1]
+
+    skip_pdf_names = ledger.done_pdf_names(archive_name) if ledger is not None else set()
+    if skip_pdf_names:
+        logger.info('%s: skipping %d PDFs converted before' % (archive_name, len(skip_pdf_names)))
+
+    tmp_dir = None
+    if args.stream:
+        logger.info('%s: converting to text' % archive_name)
+        pdf_tasks = iterate_streamed_pdf_tasks(archive_local_path, args.txt_dir, skip_pdf_names)
+    else:
+        # extract archive contents
+        tmp_dir = tempfile.mkdtemp('_arxiv_pdf_%s' % archive_name)
+        logger.info('%s: extracting to %s' % (archive_name, tmp_dir))
+        pdf_tasks = list(iterate_extracted_pdf_tasks(archive_local_path, tmp_dir, args.txt_dir, skip_pdf_names))
+        logger.info('%s: converting to text' % archive_name)
+
+    n_pdfs = 0
+    n_failed = 0
+    for task, error in convert_pdfs(pdf_tasks, args.jobs, args.timeout):
+        n_pdfs += 1
+        if error is None:
+            task['txt_size'] = os.path.getsize(task['txt_path'])
+            logger.debug('Successfully converted %s to %s' % (task['pdf_name'], task['txt_path']))
+            if text_store_writer is not None:
+                pack_text(task, text_store_writer)
+        else:
+            logger.error('Cannot convert PDF: %s from %s: %s' % (task['pdf_name'], archive_name, error))
+            n_failed += 1
+            # do not leave partial text behind
+            if os.path.exists(task['txt_path']):
+                os.remove(task['txt_path'])
+            if args.error_pdf_dir:
+                save_error_pdf(task, args.error_pdf_dir)
+        if ledger is not None:
+            ledger.record_pdf(archive_name, task, error)
+
+    if n_failed > 0:
+        logger.info('%s: %d of %d PDFs failed' % (archive_name, n_failed, n_pdfs))
+    if ledger is not None:
+        ledger.record_archive(archive_name)
+
+    if tmp_dir is not None:
+        logger.debug('Removing temp dir %s' % tmp_dir)
+        shutil.rmtree(tmp_dir)
+
+
+class S3ArchiveSource(object):
+    """
+    Files of the requester-pays arxiv bucket.
+    """
+
+    def __init__(self, host=None, port=None, bucket_name='arxiv'):
+        import boto
+        import boto.s3.connection
+
+        if host is not None:
+            s3 = boto.connect_s3(
+                host=host,
+                port=port,
+                is_secure=False,
+                calling_format=boto.s3.connection.OrdinaryCallingFormat(),
+            )
+        else:
+            s3 = boto.connect_s3()
+        self.headers = {'x-amz-request-payer': 'requester'}
+        self.bucket = s3.get_bucket(bucket_name, headers=self.headers)
+
+    def download(self, key_name, local_path):
+        key = self.bucket.get_key(key_name, headers=self.headers)
+        key.get_contents_to_filename(local_path, headers=self.headers)
+
+
+class LocalArchiveSource(object):
+    """
+    Files of a local directory with the same layout as the arxiv bucket.
+    """
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+
+    def download(self, key_name, local_path):
+        shutil.copyfile(os.path.join(self.root_dir, key_name), local_path)
+
+
+def prefetch_archives(archives, archive_source, pdf_dir, budget_bytes):
+    """
+    Download archives in a background thread and yield (archive, local path)
+    in order, so the next archives are downloaded while the current one is
+    converted.
+
+    Archives downloaded ahead plus the one being processed are kept within
+    budget_bytes of disk, but at least one archive is always allowed. An
+    archive counts as processed when the next one is requested.
+    """
+    condition = threading.Condition()
+    pending = {'bytes': 0}
+    ready = Queue.Queue()
+
+    def download_archives():
+        try:
+            for archive in archives:
+                with condition:
+                    while pending['bytes'] > 0 and pending['bytes'] + archive['size'] > budget_bytes:
+                        condition.wait()
+                    pending['bytes'] += archive['size']
+
+                archive_name = os.path.split(archive['filename'])[1]
+                archive_local_path = os.path.join(pdf_dir, archive_name)
+                if not os.path.exists(archive_local_path):
+                    logger.info('%s: downloading' % archive_name)
+                    archive_source.download(archive['filename'], archive_local_path + '.part')
+                    os.rename(archive_local_path + '.part', archive_local_path)
+                    logger.info('%s: downloaded' % archive_name)
+                else:
+                    logger.info('%s: local archive found' % archive_name)
+                ready.put((archive, archive_local_path))
+        except Exception as e:
+            logger.exception('Cannot download archive')
+            ready.put(e)
+        ready.put(None)
+
+    download_thread = threading.Thread(target=download_archives)
+    download_thread.daemon = True
+    download_thread.start()
+
+    while True:
+        item = ready.get()
+        if item is None:
+            break
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+        with condition:
+            pending['bytes'] -= item[0]['size']
+            condition.notify()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--log')
@@ -80,17 +419,30 @@ if __name__ == '__main__':
     parser.add_argument('--list', default=False, action='store_true')
     parser.add_argument('-s', '--start-month')
     parser.add_argument('-f', '--finish-month')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of parallel pdftotext processes')
+    parser.add_argument('--timeout', type=int, default=300, help='seconds allowed for one pdftotext run')
+    parser.add_argument('--stream', default=False, action='store_true',
+                        help='pipe PDFs from archive to pdftotext instead of extracting it to temp dir')
+    parser.add_argument('--prefetch-budget-mb', type=int, default=2048,
+                        help='disk space for archives downloaded ahead of conversion')
+    parser.add_argument('--source-dir', help='read archives from local mirror of the arxiv bucket')
+    parser.add_argument('--s3-host', help='S3-compatible endpoint to use instead of AWS')
+    parser.add_argument('--s3-port', type=int)
+    parser.add_argument('--txt-store',
+                        help='pack texts into sharded store in this directory, --txt-dir is used as scratch space')
+    parser.add_argument('--ledger', default='conversion_ledger.sqlite',
+                        help='SQLite file recording finished conversions, used to resume interrupted runs')
     args = parser.parse_args()
     
     setup_logging(args)
     
-    s3 = boto.connect_s3()
-    s3_headers={'x-amz-request-payer': 'requester'}
-    arxiv_bucket = s3.get_bucket('arxiv', headers=s3_headers)
+    if args.source_dir is not None:
+        archive_source = LocalArchiveSource(args.source_dir)
+    else:
+        archive_source = S3ArchiveSource(host=args.s3_host, port=args.s3_port)
     
     logger.info('Downloading arXiv_pdf_manifest.xml from arxiv bucket')
-    pdf_manifest_key = arxiv_bucket.get_key('pdf/arXiv_pdf_manifest.xml', headers=s3_headers)
-    pdf_manifest_key.get_contents_to_filename('arXiv_pdf_manifest.xml', headers=s3_headers)
+    archive_source.download('pdf/arXiv_pdf_manifest.xml', 'arXiv_pdf_manifest.xml')
     manifest_records = read_manifest('arXiv_pdf_manifest.xml')
     
     selected_archives = filter_archives(manifest_records, args.start_month, args.finish_month)
@@ -113,54 +465,33 @@ if __name__ == '__main__':
     if not os.path.exists(args.error_pdf_dir):
         os.mkdir(args.error_pdf_dir)
     
-    for archive in selected_archives:
-        archive_name = os.path.split(archive['filename'])[1]
-        
-        # get archive from bucket
-        archive_local_path = os.path.join(args.pdf_dir, archive_name)
-        if not os.path.exists(archive_local_path):
-            logger.info('%s: downloading from arxiv bucket' % archive_name)
-            archive_key = arxiv_bucket.get_key(archive['filename'], headers=s3_headers)
-            archive_key.get_contents_to_filename(archive_local_path, headers=s3_headers)
-        else:
-            logger.info('%s: local archive found' % archive_name)
-            
-        # extract archive contents
-        tmp_dir = tempfile.mkdtemp('_arxiv_pdf_%s' % archive_name)
-        logger.info('%s: extracting to %s' % (archive_name, tmp_dir))
-        archive_pdf_files = []
-        with tarfile.open(archive_local_path) as tf:
-            tf.extractall(tmp_dir)
-            for member in tf.getmembers():
-                _, member_name = os.path.split(member.name)
-                if member_name.endswith('.pdf'):
-                    pdf_name, _ = os.path.splitext(member_name)
-                    archive_pdf_files.append((pdf_name, member.name))
-                    
-        # convert archive contents to text
-        logger.info('%s: converting to text' % archive_name)
-        for pdf_name, archive_file in archive_pdf_files:
-            pdf_path = os.path.join(tmp_dir, archive_file)
-            txt_path = os.path.join(args.txt_dir, pdf_name + '.txt')
-            try:
-                cmd = ['pdftotext', '-enc', 'UTF-8', pdf_path, txt_path]
-                if args.debug:
-                    logger.debug('Running pdftotext: ' + str(cmd))
-                subprocess.check_call(cmd)
-                if args.debug:
-                    logger.debug('Successfully converted %s to %s' % (pdf_name, txt_path))
-            except subprocess.CalledProcessError as e:
-                logger.error('Cannot convert PDF: %s from %s' % (pdf_name, archive_name))
-                
-                if args.error_pdf_dir:
-                    shutil.copy(pdf_path, args.error_pdf_dir)
+    ledger = ConversionLedger(args.ledger)
+    text_store_writer = None
+    if args.txt_store is not None:
+        from arxiv_text_store import TextStoreWriter
+        text_store_writer = TextStoreWriter(args.txt_store)
+    remaining_archives = [
+        archive for archive in selected_archives
+        if not ledger.is_archive_done(os.path.split(archive['filename'])[1])
+    ]
+    if len(remaining_archives) < len(selected_archives):
+        logger.info('Skipping %d archives converted before' % (len(selected_archives) - len(remaining_archives)))
+
+    prefetched_archives = prefetch_archives(
+        remaining_archives,
+        archive_source,
+        args.pdf_dir,
+        budget_bytes=args.prefetch_budget_mb * 1024**2,
+    )
+    for archive, archive_local_path in prefetched_archives:
+        process_archive(archive_local_path, args, ledger, text_store_writer)
 
-        logger.debug('Removing temp dir %s' % tmp_dir)
-        shutil.rmtree(tmp_dir)
-        
         if args.remove_processed:
             logger.info('Removing processed archive %s' % archive_local_path)
             os.remove(archive_local_path)
 
+    ledger.close()
+    if text_store_writer is not None:
+        text_store_writer.close()
     logger.info('Finished')
 
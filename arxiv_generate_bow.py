@@ -3,50 +3,57 @@
 import os
 import sys
 import logging
+import re
+import json
+import time
+import zlib
+import hashlib
+import sqlite3
 import argparse
 import string
+import array
+import itertools
+import threading
+import collections
+import multiprocessing
 
 import nltk
 
+from arxiv_metadata_reader import iterate_arxiv_items
+
 
 logger = logging.getLogger(__name__)
 
 
-def iterate_arxiv_items(args):
-    if args.metadata is not None:
-        # read from file
-        import json
-        
-        file_reader = open
-        if args.metadata.endswith('.bz2'):
-            import bz2
-            file_reader = bz2.BZ2File
-        elif args.metadata.endswith('.gz'):
-            import gzip
-            file_reader = gzip.GzipFile
-        
-        metadata_file = file_reader(args.metadata)
-        for line in metadata_file:
-            item = json.loads(line)
-            yield item
-            
-    else:
-        # read from mongodb
-        import pymongo
-        
-        client = pymongo.MongoClient(args.db)
-        db_uri_parts = pymongo.uri_parser.parse_uri(args.db)
-        db_name = db_uri_parts['database']
-        collection_name = db_uri_parts['collection'] or 'metadata'
-        
-        arxiv_db = client[db_name]
-        metadata_collection = arxiv_db[collection_name]
-        for item in metadata_collection:
-            yield metadata_collection
-    
-    
+ITEM_FIELDS = ['title', 'abstract', 'authors', 'categories']
+
+
+class LRUCache(object):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+
+    def get(self, key):
+        value = self.data.pop(key, None)
+        if value is not None:
+            self.data[key] = value
+        return value
+
+    def put(self, key, value):
+        self.data[key] = value
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
 
 class SuperTokenizer(object):
+    """
+    Tokenizer to be created once and reused for all documents: stopwords
+    are kept in a frozenset and lemmas are cached across documents.
+
+    Mode 'nltk' uses nltk.word_tokenize, mode 'regex' uses a single regular
+    expression, which is much faster and close to it on words (compare with
+    --benchmark-tokenizers).
+    """
     UNICODE_CHARS_MAP = {
         u'\u2018': '\'',
         u'\u2019': '\'',
@@ -55,62 +62,221 @@ class SuperTokenizer(object):
         u'\xa8': '',
         u'/': ' ',
     }
-    
-    def __init__(self):
-        self.english_stopwords = nltk.corpus.stopwords.words('english')
+    UNICODE_TRANSLATE_TABLE = dict(
+        (ord(ch), ord(ch_replacement) if ch_replacement else None)
+        for ch, ch_replacement in UNICODE_CHARS_MAP.items()
+    )
+    RE_TOKEN = re.compile(r"\w+(?:[-'.]\w+)*|[^\w\s]+", re.UNICODE)
+
+    def __init__(self, mode='nltk', lemma_cache_size=1000000):
+        self.english_stopwords = frozenset(nltk.corpus.stopwords.words('english'))
         self.wordnet_lemmatizer = nltk.WordNetLemmatizer()
-        
+        self.lemma_cache = LRUCache(lemma_cache_size)
+        if mode == 'regex':
+            self.word_tokenize = SuperTokenizer.RE_TOKEN.findall
+        else:
+            self.word_tokenize = nltk.word_tokenize
+
+    def lemmatize(self, token):
+        lemma = self.lemma_cache.get(token)
+        if lemma is None:
+            lemma = self.wordnet_lemmatizer.lemmatize(token)
+            self.lemma_cache.put(token, lemma)
+        return lemma
+
     def tokenize(self, content):
 
         # replace unicode symbols with ascii analogs
-        content_processed = content
-        for ch, ch_replacement in SuperTokenizer.UNICODE_CHARS_MAP.iteritems():
-            content_processed = content_processed.replace(ch, ch_replacement)
-            
-        # apply nltk's best tokenizer
-        tokens = nltk.word_tokenize(content_processed)
-
-        # map to lower case
-        tokens = map(lambda s: s.lower(), tokens)
-        
-        # filter short tokens
-        tokens = filter(lambda s: len(s) >= 2, tokens)
-        
-        # filter stopwords
-        tokens = filter(lambda w: w not in self.english_stopwords, tokens)
-
-        # strip punctuation
-        tokens = map(lambda w: w.strip(string.punctuation), tokens)
-        
-        # lemmatize
-        tokens = [self.wordnet_lemmatizer.lemmatize(t) for t in tokens]
-        
+        content_processed = content.translate(SuperTokenizer.UNICODE_TRANSLATE_TABLE)
+
+        tokens = []
+        for token in self.word_tokenize(content_processed):
+            # map to lower case and strip punctuation
+            token = token.lower().strip(string.punctuation)
+
+            # filter short tokens and stopwords
+            if len(token) < 2 or token in self.english_stopwords:
+                continue
+
+            tokens.append(self.lemmatize(token))
+
         return tokens
 
 
+tokenizers = {}
+
+
+def get_tokenizer(mode='nltk'):
+    if mode not in tokenizers:
+        tokenizers[mode] = SuperTokenizer(mode)
+    return tokenizers[mode]
+
+
+def benchmark_tokenizers(items, args):
+    """
+    Compare speed and output of nltk and regex tokenizer modes on items.
+    """
+    nltk_tokenizer = SuperTokenizer('nltk')
+    regex_tokenizer = SuperTokenizer('regex')
+    nltk_seconds = 0.
+    regex_seconds = 0.
+    n_nltk_tokens = 0
+    n_regex_tokens = 0
+    n_common_tokens = 0
+
+    for item in items:
+        content = load_content(item, args) or u''
+        for text in (item['title'], item['abstract'], content):
+            start_time = time.time()
+            nltk_tokens = nltk_tokenizer.tokenize(text)
+            nltk_seconds += time.time() - start_time
+
+            start_time = time.time()
+            regex_tokens = regex_tokenizer.tokenize(text)
+            regex_seconds += time.time() - start_time
+
+            n_nltk_tokens += len(nltk_tokens)
+            n_regex_tokens += len(regex_tokens)
+            n_common_tokens += sum((collections.Counter(nltk_tokens) & collections.Counter(regex_tokens)).values())
+
+    logger.info('nltk: %.2f s, %d tokens' % (nltk_seconds, n_nltk_tokens))
+    logger.info('regex: %.2f s, %d tokens, %.1fx faster' % (
+        regex_seconds, n_regex_tokens, nltk_seconds / (regex_seconds + 1e-10)))
+    logger.info('Common tokens: %.2f%% of nltk, %.2f%% of regex' % (
+        float(n_common_tokens) / (n_nltk_tokens + 1e-10) * 100,
+        float(n_common_tokens) / (n_regex_tokens + 1e-10) * 100,
+    ))
+
+
 def load_content(item, args):
+    if args.text_store is not None:
+        from arxiv_text_store import text_name, decode_text
+
+        text = args.text_store.get(text_name(item['_id']))
+        if text is not None:
+            return decode_text(text)
+        return
+
     txt_filename = os.path.join(args.txt_dir, item['_id'].replace('/', '') + '.txt')
     if os.path.exists(txt_filename):
         with open(txt_filename) as txt_file:
             return txt_file.read().decode('utf8')
     
 
-def extract_features(item, content, args):
-    tokenizer = SuperTokenizer()
-    
+NAMESPACES = ('title', 'abstract', 'authors', 'categories', 'text')
+
+
+class TokenCache(object):
+    """
+    Persistent cache of tokenized title, abstract and text of items, so
+    reruns tokenize only new or changed papers.
+
+    Entries are keyed by item id and content_hash of the tokenized fields;
+    an entry with another hash is replaced. Only one process writes: caches
+    of pool workers are opened with deferred_writes, which only reads the
+    file (in WAL mode readers do not wait for the writer) and keeps new
+    entries in pending for the parent process to put.
+    """
+
+    def __init__(self, filename, commit_every=1000, deferred_writes=False):
+        self.connection = sqlite3.connect(filename, timeout=600)
+        if not deferred_writes:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS tokens ('
+                ' id TEXT PRIMARY KEY, hash TEXT, namespaces BLOB)'
+            )
+            self.connection.commit()
+        self.deferred_writes = deferred_writes
+        self.pending = []
+        self.commit_every = commit_every
+        self.n_uncommitted = 0
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def get(self, item_id, content_hash):
+        row = self.connection.execute(
+            'SELECT namespaces FROM tokens WHERE id = ? AND hash = ?', (item_id, content_hash),
+        ).fetchone()
+        if row is None:
+            self.n_misses += 1
+            return None
+        self.n_hits += 1
+        return json.loads(zlib.decompress(bytes(row[0])).decode('utf8'))
+
+    def put(self, item_id, content_hash, namespaces):
+        if self.deferred_writes:
+            self.pending.append((item_id, content_hash, namespaces))
+            return
+        data = zlib.compress(json.dumps(namespaces, separators=(',', ':')).encode('utf8'))
+        self.connection.execute(
+            'INSERT OR REPLACE INTO tokens VALUES (?, ?, ?)',
+            (item_id, content_hash, sqlite3.Binary(data)),
+        )
+        self.n_uncommitted += 1
+        if self.n_uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.n_uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+        logger.info('Token cache: %d hits, %d misses' % (self.n_hits, self.n_misses))
+
+
+def content_hash(item, content, tokenizer_mode):
+    """
+    Hash of everything tokenized for an item: tokenizer mode, title, abstract and text.
+    """
+    h = hashlib.sha1(tokenizer_mode.encode('utf8'))
+    for text in (item['title'], item['abstract'], content or u''):
+        h.update(b'\0')
+        h.update(text.encode('utf8'))
+    return h.hexdigest()
+
+
+def tokenize_namespaces(item, content, args):
+    tokenizer = get_tokenizer(args.tokenizer)
+
     namespaces = {}
-    
-    # create namespace tokens
     namespaces['title'] = tokenizer.tokenize(item['title'])
     namespaces['abstract'] = tokenizer.tokenize(item['abstract'])
+    if content:
+        namespaces['text'] = tokenizer.tokenize(content)
+    return namespaces
+
+
+def extract_namespaces(item, content, args):
+    # create namespace tokens, tokenized ones from cache if possible
+    namespaces = None
+    if args.token_cache is not None:
+        item_hash = content_hash(item, content, args.tokenizer)
+        namespaces = args.token_cache.get(item['_id'], item_hash)
+    if namespaces is None:
+        namespaces = tokenize_namespaces(item, content, args)
+        if args.token_cache is not None:
+            args.token_cache.put(item['_id'], item_hash, namespaces)
+
     namespaces['authors'] = [
         author['keyname']
         for author in item['authors']
     ]
     namespaces['categories'] = item['categories']
-    
-    if content:
-        namespaces['text'] = tokenizer.tokenize(content)
+
+    if args.vocabulary is not None:
+        namespaces = dict(
+            (ns, [token for token in tokens if token in args.vocabulary.get(ns, ())])
+            for ns, tokens in namespaces.items()
+        )
+
+    return namespaces
+
+
+def extract_features(item, content, args):
+    namespaces = extract_namespaces(item, content, args)
     
     def escape_token(word):
         return word.replace('|', '_').replace(' ', '_').replace(':', '_')
@@ -119,8 +285,339 @@ def extract_features(item, content, args):
         (u'|%s %s ' % (ns, ' '.join(map(escape_token, tokens))))
         for ns, tokens in namespaces.iteritems()
     )   
-    
-    
+
+
+class CountMinSketch(object):
+    """
+    Approximate counter of hashable keys in fixed memory. Estimates are never
+    below true counts and exceed them by about total / width with high
+    probability.
+    """
+
+    def __init__(self, width=2**22, depth=4):
+        self.width = width
+        self.rows = [array.array('i', [0]) * width for _ in range(depth)]
+
+    def add(self, key):
+        """
+        Increment count of key and return its new estimate.
+        """
+        estimate = None
+        for i, row in enumerate(self.rows):
+            j = hash((i, key)) % self.width
+            row[j] += 1
+            if estimate is None or row[j] < estimate:
+                estimate = row[j]
+        return estimate
+
+    def estimate(self, key):
+        return min(
+            row[hash((i, key)) % self.width]
+            for i, row in enumerate(self.rows)
+        )
+
+
+class VocabularyBuilder(object):
+    """
+    First pass of vocabulary pruning: count document frequencies of tokens
+    by namespace in a count-min sketch. Only tokens whose estimate reaches
+    min_df are remembered, so hapaxes and OCR junk cost nothing besides
+    the sketch itself.
+    """
+
+    def __init__(self, min_df=2, max_df_ratio=1.0, top_k=None, sketch_width=2**22):
+        self.min_df = min_df
+        self.max_df_ratio = max_df_ratio
+        self.top_k = top_k
+        self.sketch = CountMinSketch(sketch_width)
+        self.candidates = collections.defaultdict(set)
+        self.n_documents = 0
+
+    def add(self, namespace_counts):
+        self.n_documents += 1
+        for ns, counts in namespace_counts.items():
+            candidates = self.candidates[ns]
+            for token in counts:
+                if self.sketch.add((ns, token)) >= self.min_df:
+                    candidates.add(token)
+
+    def vocabulary(self):
+        """
+        Return dict of namespace -> [(token, df)] with pruning applied,
+        most frequent tokens first.
+        """
+        max_df = self.max_df_ratio * self.n_documents
+        vocabulary = {}
+        for ns, candidates in self.candidates.items():
+            tokens = []
+            for token in candidates:
+                df = self.sketch.estimate((ns, token))
+                if self.min_df <= df <= max_df:
+                    tokens.append((token, df))
+            tokens.sort(key=lambda token_df: (-token_df[1], token_df[0]))
+            if self.top_k is not None:
+                tokens = tokens[:self.top_k]
+            vocabulary[ns] = tokens
+        return vocabulary
+
+
+def write_vocabulary(filename, vocabulary):
+    with open(filename, 'w') as vocabulary_file:
+        for ns, tokens in sorted(vocabulary.items()):
+            for token, df in tokens:
+                vocabulary_file.write(('%s\t%s\t%d\n' % (ns, token, df)).encode('utf8'))
+
+
+def read_vocabulary(filename):
+    """
+    Read vocabulary written by write_vocabulary as dict of namespace -> [token].
+    """
+    vocabulary = collections.defaultdict(list)
+    with open(filename) as vocabulary_file:
+        for line in vocabulary_file:
+            ns, token, _ = line.decode('utf8').rstrip('\n').split('\t')
+            vocabulary[ns].append(token)
+    return dict(vocabulary)
+
+
+def build_vocabulary(args):
+    """
+    Run the counting pass over all items and write pruned vocabulary to
+    args.vocabulary_file.
+    """
+    count_args = argparse.Namespace(**vars(args))
+    count_args.output_format = 'csr'
+    count_args.vocabulary = None
+    count_args.vocabulary_file = None
+    if args.workers > 1:
+        features = iterate_features_parallel(iterate_arxiv_items(args, ITEM_FIELDS), count_args)
+    else:
+        features = iterate_features(iterate_arxiv_items(args, ITEM_FIELDS), count_args)
+
+    builder = VocabularyBuilder(args.min_df, args.max_df_ratio, args.top_k, args.sketch_width)
+    for n, (item_id, namespace_counts) in enumerate(features):
+        builder.add(namespace_counts)
+        if n % 1000 == 0 and n > 0:
+            logger.info('Counted tokens of %d items' % n)
+
+    vocabulary = builder.vocabulary()
+    for ns, tokens in sorted(vocabulary.items()):
+        logger.info('Namespace %s: %d of %d candidate tokens kept' % (
+            ns, len(tokens), len(builder.candidates[ns])))
+    write_vocabulary(args.vocabulary_file, vocabulary)
+
+
+class SparseMatrixWriter(object):
+    """
+    Write token counts as one CSR matrix per namespace, with vocabularies
+    built on the fly. Files in output_dir:
+
+        ids.txt                         item id of every row
+        <ns>.vocab.txt                  token of every column
+        <ns>.indptr.npy, <ns>.indices.npy, <ns>.data.npy
+                                        CSR arrays, see load_sparse_matrix
+
+    Column indices and counts are spooled to disk while writing, so only
+    vocabularies and row pointers are kept in memory. If vocabularies
+    (namespace -> [token]) are given, columns follow their order.
+    """
+
+    def __init__(self, output_dir, namespaces=NAMESPACES, vocabularies=None):
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        self.output_dir = output_dir
+        self.namespaces = namespaces
+        self.ids_file = open(os.path.join(output_dir, 'ids.txt'), 'w')
+        self.vocabularies = dict((ns, {}) for ns in namespaces)
+        for ns, tokens in (vocabularies or {}).items():
+            self.vocabularies[ns] = dict((token, index) for index, token in enumerate(tokens))
+        self.indptr = dict((ns, array.array('l', [0])) for ns in namespaces)
+        self.spool_files = dict(
+            ((ns, name), open(self.file_name(ns, name + '.tmp'), 'wb'))
+            for ns in namespaces
+            for name in ('indices', 'data')
+        )
+
+    def file_name(self, namespace, name):
+        return os.path.join(self.output_dir, '%s.%s' % (namespace, name))
+
+    def add(self, item_id, namespace_counts):
+        self.ids_file.write(item_id + '\n')
+        for ns in self.namespaces:
+            vocabulary = self.vocabularies[ns]
+            columns = sorted(
+                (vocabulary.setdefault(token, len(vocabulary)), count)
+                for token, count in namespace_counts.get(ns, {}).items()
+            )
+            if columns:
+                indices, counts = zip(*columns)
+                array.array('i', indices).tofile(self.spool_files[ns, 'indices'])
+                array.array('i', counts).tofile(self.spool_files[ns, 'data'])
+            indptr = self.indptr[ns]
+            indptr.append(indptr[-1] + len(columns))
+
+    def close(self):
+        import numpy as np
+
+        self.ids_file.close()
+        for ns in self.namespaces:
+            indptr = np.array(self.indptr[ns], dtype=np.int64)
+            np.save(self.file_name(ns, 'indptr.npy'), indptr)
+
+            nnz = int(indptr[-1])
+            for name in ('indices', 'data'):
+                spool_filename = self.file_name(ns, name + '.tmp')
+                self.spool_files[ns, name].close()
+                array_file = np.lib.format.open_memmap(
+                    self.file_name(ns, name + '.npy'), mode='w+', dtype=np.int32, shape=(nnz,))
+                if nnz > 0:
+                    array_file[:] = np.memmap(spool_filename, dtype=np.int32, mode='r')
+                del array_file
+                os.remove(spool_filename)
+
+            vocabulary = self.vocabularies[ns]
+            tokens = sorted(vocabulary, key=vocabulary.get)
+            with open(self.file_name(ns, 'vocab.txt'), 'w') as vocab_file:
+                for token in tokens:
+                    vocab_file.write(token.encode('utf8') + '\n')
+            logger.info('Namespace %s: %d rows, %d tokens, %d nonzeros' % (
+                ns, len(indptr) - 1, len(tokens), nnz))
+
+
+def load_sparse_matrix(matrix_dir, namespace, mmap_mode='r'):
+    """
+    Load CSR matrix of namespace written by SparseMatrixWriter, with arrays
+    memory-mapped. Returns scipy.sparse.csr_matrix if scipy is available,
+    otherwise (data, indices, indptr, shape) tuple.
+    """
+    import numpy as np
+
+    def load(name):
+        return np.load(os.path.join(matrix_dir, '%s.%s.npy' % (namespace, name)), mmap_mode=mmap_mode)
+
+    data, indices, indptr = load('data'), load('indices'), load('indptr')
+    with open(os.path.join(matrix_dir, '%s.vocab.txt' % namespace)) as vocab_file:
+        n_columns = sum(1 for _ in vocab_file)
+    shape = (len(indptr) - 1, n_columns)
+
+    try:
+        import scipy.sparse
+    except ImportError:
+        return data, indices, indptr, shape
+    return scipy.sparse.csr_matrix((data, indices, indptr), shape=shape)
+
+
+def iterate_features(items, args):
+    """
+    Yield VW line for every item, or (item id, token counts by namespace)
+    for csr output format.
+    """
+    for item in items:
+        content = load_content(item, args)
+        if args.output_format == 'csr':
+            namespaces = extract_namespaces(item, content, args)
+            yield item['_id'], dict(
+                (ns, collections.Counter(tokens))
+                for ns, tokens in namespaces.items()
+            )
+        else:
+            yield extract_features(item, content, args).encode('utf8')
+
+
+worker_args = None
+
+
+def init_worker(txt_dir, txt_store, tokenizer, output_format, vocabulary_file, token_cache_file):
+    global worker_args
+    worker_args = argparse.Namespace(
+        txt_dir=txt_dir, text_store=None, tokenizer=tokenizer, output_format=output_format,
+        vocabulary=None, token_cache=None)
+    if token_cache_file is not None:
+        worker_args.token_cache = TokenCache(token_cache_file, deferred_writes=True)
+    if vocabulary_file is not None:
+        worker_args.vocabulary = dict(
+            (ns, frozenset(tokens))
+            for ns, tokens in read_vocabulary(vocabulary_file).items()
+        )
+    if txt_store is not None:
+        from arxiv_text_store import open_text_store
+        worker_args.text_store = open_text_store(txt_store)
+    get_tokenizer(tokenizer)
+
+
+def process_items_chunk(items):
+    """
+    Return features of items, and new token cache entries with number of
+    cache hits, which the parent process records.
+    """
+    features = list(iterate_features(items, worker_args))
+    cache_entries = []
+    n_cache_hits = 0
+    token_cache = worker_args.token_cache
+    if token_cache is not None:
+        cache_entries, token_cache.pending = token_cache.pending, []
+        n_cache_hits, token_cache.n_hits = token_cache.n_hits, 0
+    return features, cache_entries, n_cache_hits
+
+
+def iterate_chunks(items, chunk_size):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, chunk_size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def iterate_features_parallel(items, args):
+    """
+    Extract features in a pool of args.workers processes, each with its own
+    tokenizer and text store handle. Items are sent in chunks, at most
+    2 * workers chunks in flight. Features come in input order unless
+    args.unordered is set; each of them carries item id anyway.
+
+    Workers only read the token cache; tokens of cache misses are written
+    to args.token_cache here, so workers never wait for a write lock.
+    """
+    token_cache = args.token_cache
+    if token_cache is not None:
+        token_cache.commit()
+
+    pool = multiprocessing.Pool(
+        args.workers,
+        initializer=init_worker,
+        initargs=(args.txt_dir, args.txt_store, args.tokenizer, args.output_format,
+                  args.vocabulary_file, args.token_cache_file),
+    )
+    slots = threading.BoundedSemaphore(2 * args.workers)
+
+    def iterate_limited_chunks():
+        for chunk in iterate_chunks(items, args.chunk_size):
+            slots.acquire()
+            yield chunk
+
+    imap = pool.imap_unordered if args.unordered else pool.imap
+    try:
+        for features, cache_entries, n_cache_hits in imap(process_items_chunk, iterate_limited_chunks()):
+            slots.release()
+            if token_cache is not None:
+                token_cache.n_hits += n_cache_hits
+                token_cache.n_misses += len(cache_entries)
+                for cache_entry in cache_entries:
+                    token_cache.put(*cache_entry)
+            for item_features in features:
+                yield item_features
+        pool.close()
+    finally:
+        # unblock the task feeding thread waiting for a slot, if a worker failed
+        for _ in range(2 * args.workers):
+            try:
+                slots.release()
+            except ValueError:
+                break
+        pool.terminate()
+        pool.join()
+
     
 if __name__ == '__main__':    
     logger.setLevel(logging.DEBUG)
@@ -135,13 +632,78 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--db', default='mongodb://localhost:27017/arxiv')
     parser.add_argument('--metadata')
+    parser.add_argument('--metadata-store')
     parser.add_argument('--txt-dir', default='txt')
+    parser.add_argument('--txt-store', help='read texts from sharded text store instead of --txt-dir')
     parser.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout)
+    parser.add_argument('--output-format', choices=['vw', 'csr'], default='vw',
+                        help='Vowpal Wabbit lines to --output, or CSR matrices to --output-dir')
+    parser.add_argument('--output-dir', help='directory for csr output format')
+    parser.add_argument('--tokenizer', choices=['nltk', 'regex'], default='nltk')
+    parser.add_argument('--benchmark-tokenizers', type=int, metavar='N',
+                        help='compare tokenizer modes on first N items and exit')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--chunk-size', type=int, default=100, help='items sent to a worker at once')
+    parser.add_argument('--unordered', default=False, action='store_true',
+                        help='write lines as workers finish instead of input order')
+    parser.add_argument('--vocabulary', dest='vocabulary_file',
+                        help='keep only tokens listed in this vocabulary file')
+    parser.add_argument('--build-vocabulary', default=False, action='store_true',
+                        help='first count tokens of all items and write pruned --vocabulary')
+    parser.add_argument('--min-df', type=int, default=2, help='minimum document frequency of a token')
+    parser.add_argument('--max-df-ratio', type=float, default=1.0,
+                        help='maximum fraction of documents containing a token')
+    parser.add_argument('--top-k', type=int, help='keep at most K most frequent tokens per namespace')
+    parser.add_argument('--sketch-width', type=int, default=2**22,
+                        help='counters per row of count-min sketch used for document frequencies')
+    parser.add_argument('--token-cache', dest='token_cache_file',
+                        help='SQLite file caching tokens of items between runs')
     args = parser.parse_args()
+    if args.output_format == 'csr' and args.output_dir is None:
+        parser.error('--output-dir is required for csr output format')
+    if args.build_vocabulary and args.vocabulary_file is None:
+        parser.error('--vocabulary is required with --build-vocabulary')
+
+    args.text_store = None
+    if args.txt_store is not None:
+        from arxiv_text_store import open_text_store
+        args.text_store = open_text_store(args.txt_store)
+
+    args.token_cache = None
+    if args.token_cache_file is not None:
+        args.token_cache = TokenCache(args.token_cache_file)
+
+    if args.benchmark_tokenizers is not None:
+        benchmark_tokenizers(itertools.islice(iterate_arxiv_items(args, ITEM_FIELDS), args.benchmark_tokenizers), args)
+        sys.exit(0)
+
+    if args.build_vocabulary:
+        build_vocabulary(args)
+
+    args.vocabulary = None
+    vocabulary_tokens = None
+    if args.vocabulary_file is not None:
+        vocabulary_tokens = read_vocabulary(args.vocabulary_file)
+        args.vocabulary = dict((ns, frozenset(tokens)) for ns, tokens in vocabulary_tokens.items())
     
-    for n, arxiv_item in enumerate(iterate_arxiv_items(args)):
-        content = load_content(arxiv_item, args)
-        line = extract_features(arxiv_item, content, args)
-        args.output.write(line.encode('utf8') + '\n')
+    if args.workers > 1:
+        features = iterate_features_parallel(iterate_arxiv_items(args, ITEM_FIELDS), args)
+    else:
+        features = iterate_features(iterate_arxiv_items(args, ITEM_FIELDS), args)
+
+    matrix_writer = None
+    if args.output_format == 'csr':
+        matrix_writer = SparseMatrixWriter(args.output_dir, vocabularies=vocabulary_tokens)
+
+    for n, item_features in enumerate(features):
+        if matrix_writer is not None:
+            matrix_writer.add(*item_features)
+        else:
+            args.output.write(item_features + '\n')
         if n % 100 == 0 and n > 0:
             logger.info('Processed %d items' % n)
+
+    if matrix_writer is not None:
+        matrix_writer.close()
+    if args.token_cache is not None:
+        args.token_cache.close()
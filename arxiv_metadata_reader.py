@@ -0,0 +1,294 @@
+"""
+Reading metadata items for dataset tools from a JSON lines dump (see
+arxiv_collect_metadata.py --write-jsonlines-file), the columnar metadata
+store or MongoDB.
+
+Compressed dumps (.bz2, .gz, .zst) are decompressed by an external tool
+running in parallel with JSON decoding: lbzip2 or pbzip2 decompress
+multi-stream bz2 files block-parallel, pigz and zstd take the work off the
+reading process. Python modules are used when no tool is installed. Lines
+are decoded with orjson or ujson if available.
+"""
+
+import os
+import json
+import logging
+import subprocess
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    try:
+        from ujson import loads as json_loads
+    except ImportError:
+        from json import loads as json_loads
+
+__all__ = [
+    'open_jsonlines',
+    'iterate_jsonlines_batches',
+    'build_jsonlines_index',
+    'has_jsonlines_index',
+    'read_jsonlines_index',
+    'iterate_jsonlines_at',
+    'iterate_arxiv_batches',
+    'iterate_arxiv_items',
+]
+
+
+logger = logging.getLogger(__name__)
+
+
+DECOMPRESS_COMMANDS = {
+    '.bz2': [['lbzip2', '-dc'], ['pbzip2', '-dc'], ['bzip2', '-dc']],
+    '.gz': [['pigz', '-dc'], ['gzip', '-dc']],
+    '.zst': [['zstd', '-dcq']],
+}
+
+
+def find_executable(name):
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        executable = os.path.join(path, name)
+        if os.path.isfile(executable) and os.access(executable, os.X_OK):
+            return executable
+
+
+def open_decompressed(filename, extension):
+    if extension == '.bz2':
+        import bz2
+        return bz2.BZ2File(filename)
+    elif extension == '.gz':
+        import gzip
+        return gzip.GzipFile(filename)
+    else:
+        import io
+        import zstandard
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb')))
+
+
+def open_jsonlines(filename):
+    """
+    Return (file, process) for reading lines of possibly compressed file;
+    process is the decompressing tool or None.
+    """
+    extension = os.path.splitext(filename)[1]
+    if extension not in DECOMPRESS_COMMANDS:
+        return open(filename, 'rb'), None
+
+    for command in DECOMPRESS_COMMANDS[extension]:
+        if find_executable(command[0]) is not None:
+            logger.info('Decompressing %s with %s' % (filename, command[0]))
+            process = subprocess.Popen(command + [filename], stdout=subprocess.PIPE, bufsize=1024**2)
+            return process.stdout, process
+
+    return open_decompressed(filename, extension), None
+
+
+def project(item, fields):
+    return dict((name, item[name]) for name in fields if name in item)
+
+
+def iterate_jsonlines_batches(filename, fields=None, start_date=None, finish_date=None, batch_size=1000):
+    """
+    Yield lists of up to batch_size items of JSON lines file, keeping only
+    fields (and _id) of items created in the date range.
+    """
+    if fields is not None:
+        fields = ['_id'] + [name for name in fields if name != '_id']
+
+    lines, process = open_jsonlines(filename)
+    try:
+        batch = []
+        for line in lines:
+            item = json_loads(line)
+            if start_date is not None or finish_date is not None:
+                created_date = item['info'].get('created')
+                if start_date is not None and (created_date is None or created_date < start_date):
+                    continue
+                if finish_date is not None and (created_date is None or created_date > finish_date):
+                    continue
+            if fields is not None:
+                item = project(item, fields)
+            batch.append(item)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if process is not None:
+            lines.close()
+            returncode = process.wait()
+            if returncode != 0:
+                raise IOError('Decompressing %s failed with exit status %d' % (filename, returncode))
+        if batch:
+            yield batch
+    finally:
+        lines.close()
+        # reading stopped early: the tool is killed on purpose
+        if process is not None and process.poll() is None:
+            process.kill()
+            process.wait()
+
+
+def index_file_names(filename):
+    return filename + '.index.tsv', filename + '.index.json'
+
+
+def file_signature(filename):
+    stat = os.stat(filename)
+    return {'size': stat.st_size, 'mtime': int(stat.st_mtime)}
+
+
+def build_jsonlines_index(filename):
+    """
+    Write sidecar index of uncompressed JSON lines file: a row of info.created,
+    _id, byte offset and length per line, sorted by info.created, and
+    offsets of every created month in the index.
+    """
+    if os.path.splitext(filename)[1] in DECOMPRESS_COMMANDS:
+        raise ValueError('Only uncompressed JSON lines file can be indexed: %s' % filename)
+    index_tsv_filename, index_json_filename = index_file_names(filename)
+
+    rows = []
+    offset = 0
+    with open(filename, 'rb') as lines:
+        for line in lines:
+            item = json_loads(line)
+            rows.append((item['info'].get('created') or '', item['_id'], offset, len(line)))
+            offset += len(line)
+    rows.sort(key=lambda row: (row[0], row[2]))
+
+    months = {}
+    with open(index_tsv_filename, 'w') as index_file:
+        for created_date, item_id, offset, length in rows:
+            month = created_date[:7]
+            if month not in months:
+                months[month] = index_file.tell()
+            index_file.write('%s\t%s\t%d\t%d\n' % (created_date, item_id, offset, length))
+
+    with open(index_json_filename, 'w') as index_file:
+        json.dump({'file': file_signature(filename), 'months': months}, index_file, sort_keys=True)
+    logger.info('Indexed %d items of %s' % (len(rows), filename))
+
+
+def has_jsonlines_index(filename):
+    """
+    Check that filename has an index built after its last modification.
+    """
+    index_json_filename = index_file_names(filename)[1]
+    if not os.path.exists(index_json_filename):
+        return False
+    with open(index_json_filename) as index_file:
+        return json.load(index_file)['file'] == file_signature(filename)
+
+
+def read_jsonlines_index(filename, start_date=None, finish_date=None):
+    """
+    Yield (created date, _id, offset, length) from the index of filename for
+    items created in the date range, seeking to the first month in range.
+    Items without created date are yielded only if no range is given.
+    """
+    index_tsv_filename, index_json_filename = index_file_names(filename)
+    with open(index_json_filename) as index_file:
+        months = json.load(index_file)['months']
+
+    start_offset = 0
+    if start_date is not None:
+        months_in_range = [month for month in months if month >= start_date[:7]]
+        if not months_in_range:
+            return
+        start_offset = months[min(months_in_range)]
+
+    with open(index_tsv_filename) as index_file:
+        index_file.seek(start_offset)
+        for line in index_file:
+            created_date, item_id, offset, length = line.rstrip('\n').split('\t')
+            if finish_date is not None and created_date > finish_date:
+                break
+            if (start_date is not None or finish_date is not None) and not created_date:
+                continue
+            if start_date is not None and created_date < start_date:
+                continue
+            yield created_date, item_id, int(offset), int(length)
+
+
+def iterate_jsonlines_at(filename, locations, fields=None):
+    """
+    Yield items of lines at (offset, length) locations, reading them in file order.
+    """
+    if fields is not None:
+        fields = ['_id'] + [name for name in fields if name != '_id']
+
+    with open(filename, 'rb') as lines:
+        for offset, length in sorted(locations):
+            if lines.tell() != offset:
+                lines.seek(offset)
+            item = json_loads(lines.read(length))
+            if fields is not None:
+                item = project(item, fields)
+            yield item
+
+
+def iterate_store_batches(store_dir, fields=None, start_date=None, finish_date=None, batch_size=1000):
+    from arxiv_metadata_store import read_metadata
+
+    batch = []
+    for item in read_metadata(store_dir, columns=fields, start_date=start_date, finish_date=finish_date):
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iterate_mongodb_batches(db, fields=None, start_date=None, finish_date=None, batch_size=1000):
+    import pymongo
+
+    client = pymongo.MongoClient(db)
+    db_uri_parts = pymongo.uri_parser.parse_uri(db)
+    db_name = db_uri_parts['database']
+    collection_name = db_uri_parts['collection'] or 'metadata'
+    metadata_collection = client[db_name][collection_name]
+
+    query = {}
+    if start_date is not None:
+        query.setdefault('info.created', {})['$gte'] = start_date
+    if finish_date is not None:
+        query.setdefault('info.created', {})['$lte'] = finish_date
+    projection = dict((name, True) for name in fields) if fields is not None else None
+
+    batch = []
+    for item in metadata_collection.find(query, projection, batch_size=batch_size):
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iterate_arxiv_batches(args, fields=None, start_date=None, finish_date=None, batch_size=1000):
+    """
+    Yield lists of items from args.metadata_store, args.metadata file or
+    args.db, whichever is given first.
+
+    fields: top-level fields to read besides _id, all if None
+    start_date, finish_date: range of info.created, inclusive
+    """
+    if args.metadata_store is not None:
+        iterate_batches = iterate_store_batches
+        source = args.metadata_store
+    elif args.metadata is not None:
+        iterate_batches = iterate_jsonlines_batches
+        source = args.metadata
+    else:
+        iterate_batches = iterate_mongodb_batches
+        source = args.db
+    return iterate_batches(source, fields, start_date, finish_date, batch_size)
+
+
+def iterate_arxiv_items(args, fields=None, start_date=None, finish_date=None):
+    """
+    Yield items one by one, see iterate_arxiv_batches.
+    """
+    for batch in iterate_arxiv_batches(args, fields, start_date, finish_date):
+        for item in batch:
+            yield item
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+"""
+Columnar store of arXiv metadata, MongoDB-free alternative backend.
+
+Records parsed from arXiv pages go to Parquet files partitioned by the
+month of info.created:
+
+    <store_dir>/arXiv/created_month=2007-04/part-00000.parquet
+
+Records parsed from arXivRaw pages (submitter and versions) go to a
+separate unpartitioned table <store_dir>/arXivRaw/ and are joined by _id
+on read when their columns are requested.
+
+Requirements:
+  - pip install pyarrow
+"""
+
+import os
+import json
+import logging
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+__all__ = [
+    'MetadataStoreWriter',
+    'read_metadata',
+]
+
+
+logger = logging.getLogger(__name__)
+
+
+AUTHOR_TYPE = pa.struct([
+    ('keyname', pa.string()),
+    ('forenames', pa.string()),
+    ('name', pa.string()),
+])
+
+VERSION_TYPE = pa.struct([
+    ('version', pa.string()),
+    ('size', pa.string()),
+    ('date', pa.string()),
+])
+
+SCHEMAS = {
+    'arXiv': [
+        ('_id', pa.string()),
+        ('created', pa.string()),
+        ('oai_id', pa.string()),
+        ('oai_datestamp', pa.string()),
+        ('oai_specs', pa.list_(pa.string())),
+        ('title', pa.string()),
+        ('abstract', pa.string()),
+        ('categories', pa.list_(pa.string())),
+        ('authors', pa.list_(AUTHOR_TYPE)),
+        ('info', pa.string()),
+    ],
+    'arXivRaw': [
+        ('_id', pa.string()),
+        ('submitter', pa.string()),
+        ('versions', pa.list_(VERSION_TYPE)),
+    ],
+}
+
+RAW_COLUMNS = ('submitter', 'versions')
+
+
+def created_month(created):
+    if created is None:
+        return 'unknown'
+    return created[:7]
+
+
+def to_row(obj, table_name):
+    """
+    Convert record in collect_metadata format (with _id) to store row.
+    """
+    row = dict(obj)
+    if table_name == 'arXiv':
+        row['categories'] = list(row['categories'])
+        row['created'] = row['info'].get('created')
+        row['info'] = json.dumps(row['info'], separators=(',', ':'))
+    return row
+
+
+def from_row(row):
+    if row.get('info') is not None:
+        row['info'] = json.loads(row['info'])
+    return row
+
+
+class MetadataStoreWriter(object):
+    """
+    Buffer rows of one table and write them as Parquet files.
+
+    Rows of arXiv table are grouped by created month; all buffered
+    partitions are flushed when rows_per_flush rows are accumulated.
+    Table must not have files yet: parts of a previous run would be partly
+    overwritten and partly duplicate new rows.
+    """
+
+    def __init__(self, store_dir, table_name, rows_per_flush=100000):
+        self.table_dir = os.path.join(store_dir, table_name)
+        if any(True for _ in iterate_table_files(self.table_dir)):
+            raise ValueError('Table %s is not empty, remove it to write again' % self.table_dir)
+        self.table_name = table_name
+        self.schema = SCHEMAS[table_name]
+        self.rows_per_flush = rows_per_flush
+        self.partitions = {}
+        self.n_buffered = 0
+        self.n_written = 0
+        self.next_part_id = 0
+
+    def write(self, obj):
+        row = to_row(obj, self.table_name)
+        if self.table_name == 'arXiv':
+            partition = 'created_month=%s' % created_month(row['created'])
+        else:
+            partition = ''
+        self.partitions.setdefault(partition, []).append(row)
+        self.n_buffered += 1
+        if self.n_buffered >= self.rows_per_flush:
+            self.flush()
+
+    def flush(self):
+        for partition, rows in sorted(self.partitions.items()):
+            partition_dir = os.path.join(self.table_dir, partition)
+            if not os.path.exists(partition_dir):
+                os.makedirs(partition_dir)
+
+            arrays = [
+                pa.array([row.get(name) for row in rows], type=type)
+                for name, type in self.schema
+            ]
+            table = pa.Table.from_arrays(arrays, [name for name, _ in self.schema])
+            part_filename = os.path.join(partition_dir, 'part-%.5d.parquet' % self.next_part_id)
+            pq.write_table(table, part_filename)
+            self.n_written += len(rows)
+
+        if self.partitions:
+            logger.info('Written %d %s records to %s' % (self.n_buffered, self.table_name, self.table_dir))
+            self.next_part_id += 1
+        self.partitions = {}
+        self.n_buffered = 0
+
+    def close(self):
+        self.flush()
+
+
+def iterate_table_files(table_dir, start_month=None, finish_month=None):
+    """
+    List Parquet files of table, skipping created_month partitions out of range.
+    """
+    if not os.path.exists(table_dir):
+        return
+    for dirpath, dirnames, filenames in os.walk(table_dir):
+        dirnames.sort()
+        partition = os.path.basename(dirpath)
+        if partition.startswith('created_month='):
+            month = partition.split('=', 1)[1]
+            if start_month is not None and (month == 'unknown' or month < start_month):
+                continue
+            if finish_month is not None and (month == 'unknown' or month > finish_month):
+                continue
+        for filename in sorted(filenames):
+            if filename.endswith('.parquet'):
+                yield os.path.join(dirpath, filename)
+
+
+def iterate_table_rows(filename, columns, filters=None):
+    table = pq.read_table(filename, columns=columns, filters=filters)
+    data = table.to_pydict()
+    names = list(data.keys())
+    for values in zip(*[data[name] for name in names]):
+        yield dict(zip(names, values))
+
+
+def date_filters(start_date=None, finish_date=None):
+    filters = []
+    if start_date is not None:
+        filters.append(('created', '>=', start_date))
+    if finish_date is not None:
+        filters.append(('created', '<=', finish_date))
+    return filters or None
+
+
+def read_raw_metadata(store_dir, columns, ids=None):
+    """
+    Return dict of _id -> row of arXivRaw table, only for ids if given.
+    """
+    filters = [('_id', 'in', ids)] if ids is not None else None
+    raw_rows = {}
+    for filename in iterate_table_files(os.path.join(store_dir, 'arXivRaw')):
+        for row in iterate_table_rows(filename, ['_id'] + columns, filters):
+            raw_rows[row.pop('_id')] = row
+    return raw_rows
+
+
+def read_metadata(store_dir, columns=None, start_date=None, finish_date=None):
+    """
+    Yield metadata items from the store, reading only requested columns.
+
+    Date range is compared with info.created like in arxiv_subsample: whole
+    month partitions out of range are not opened, rows inside boundary
+    months are filtered by the created column while reading. With a date
+    range, arXivRaw rows are loaded only for items in range.
+    """
+    if columns is None:
+        # created is a copy of info.created kept for filtering
+        columns = [name for name, _ in SCHEMAS['arXiv'] if name != 'created'] + list(RAW_COLUMNS)
+
+    raw_columns = [name for name in columns if name in RAW_COLUMNS]
+    read_columns = ['_id'] + [name for name in columns if name not in RAW_COLUMNS and name != '_id']
+    filters = date_filters(start_date, finish_date)
+    table_files = list(iterate_table_files(
+        os.path.join(store_dir, 'arXiv'),
+        start_month=start_date[:7] if start_date is not None else None,
+        finish_month=finish_date[:7] if finish_date is not None else None,
+    ))
+
+    raw_rows = {}
+    if raw_columns:
+        ids = None
+        if filters is not None:
+            ids = [
+                row['_id']
+                for filename in table_files
+                for row in iterate_table_rows(filename, ['_id'], filters)
+            ]
+        raw_rows = read_raw_metadata(store_dir, raw_columns, ids)
+
+    for filename in table_files:
+        for row in iterate_table_rows(filename, read_columns, filters):
+            if raw_columns:
+                row.update(raw_rows.get(row['_id'], dict.fromkeys(raw_columns)))
+            yield from_row(row)
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+"""
+Local stand-in for arXiv OAI-PMH endpoint, for offline harvester benchmarks.
+
+Serves ListRecords pages either replayed from a directory of harvested
+records_<prefix>_*.xml files, or generated synthetically. Can emulate
+latency and 503 responses with Retry-After like export.arxiv.org does.
+
+Example:
+    ./arxiv_oai_mock_server.py --port 8000 --pages 100 &
+    ./arxiv_download_metadata.py --oai-url http://localhost:8000/oai2 --output-dir /tmp/metadata
+"""
+
+import os
+import time
+import random
+import logging
+import argparse
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+from lxml import etree
+
+from arxiv_download_metadata import metadata_output_file_name, find_metadata_file, open_metadata_file
+
+
+logger = logging.getLogger(__name__)
+
+
+PAGE_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">
+<responseDate>2016-01-01T00:00:00Z</responseDate>
+<request verb="ListRecords" metadataPrefix="{metadata_prefix}">http://export.arxiv.org/oai2</request>
+<ListRecords>
+{records}
+<resumptionToken cursor="{cursor}" completeListSize="{complete_list_size}">{token}</resumptionToken>
+</ListRecords>
+</OAI-PMH>
+'''
+
+RECORD_TEMPLATE = '''<record>
+<header>
+ <identifier>oai:arXiv.org:{arxiv_id}</identifier>
+ <datestamp>{datestamp}</datestamp>
+ <setSpec>cs</setSpec>
+</header>
+<metadata>
+ <arXiv xmlns="http://arxiv.org/OAI/arXiv/">
+ <id>{arxiv_id}</id><created>{datestamp}</created>
+ <authors><author><keyname>Doe</keyname><forenames>John</forenames></author></authors>
+ <title>Synthetic paper {arxiv_id}</title>
+ <categories>cs.LG stat.ML</categories>
+ <abstract>{abstract}</abstract>
+ </arXiv>
+</metadata>
+</record>'''
+
+
+def page_token(page_id):
+    return '%d|mock' % page_id
+
+
+def generate_page(metadata_prefix, page_id, n_pages, records_per_page):
+    records = []
+    for n in range(records_per_page):
+        item_number = page_id * records_per_page + n
+        records.append(RECORD_TEMPLATE.format(
+            arxiv_id='%.4d.%.5d' % (1000 + item_number // 100000, item_number % 100000),
+            datestamp='20%.2d-%.2d-01' % (10 + item_number // 1200000 % 10, 1 + item_number // 100000 % 12),
+            abstract='Lorem ipsum dolor sit amet. ' * 40,
+        ))
+    return PAGE_TEMPLATE.format(
+        metadata_prefix=metadata_prefix,
+        records='\n'.join(records),
+        cursor=page_id * records_per_page,
+        complete_list_size=n_pages * records_per_page,
+        token=page_token(page_id + 1) if page_id + 1 < n_pages else '',
+    ).encode('utf8')
+
+
+def replace_page_token(content, page_id, n_pages):
+    root = etree.fromstring(content)
+    resumption_token_element = root\
+        .find('{http://www.openarchives.org/OAI/2.0/}ListRecords')\
+        .find('{http://www.openarchives.org/OAI/2.0/}resumptionToken')
+    resumption_token_element.text = page_token(page_id + 1) if page_id + 1 < n_pages else ''
+    return etree.tostring(root, xml_declaration=True, encoding='UTF-8')
+
+
+class MockOAIServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, args):
+        HTTPServer.__init__(self, address, MockOAIRequestHandler)
+        self.args = args
+        if args.replay_dir is not None:
+            self.n_pages = 0
+            while self.replay_file_name(self.n_pages) is not None:
+                self.n_pages += 1
+        else:
+            self.n_pages = args.pages
+
+    def replay_file_name(self, page_id):
+        return find_metadata_file(os.path.join(
+            self.args.replay_dir,
+            metadata_output_file_name(self.args.metadata_prefix, page_id),
+        ))
+
+    def get_page(self, page_id):
+        if self.args.replay_dir is not None:
+            with open_metadata_file(self.replay_file_name(page_id)) as f:
+                return replace_page_token(f.read(), page_id, self.n_pages)
+        return generate_page(self.args.metadata_prefix, page_id, self.n_pages, self.args.records_per_page)
+
+
+class MockOAIRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        args = self.server.args
+        params = parse_qs(urlparse(self.path).query)
+
+        if args.latency > 0:
+            time.sleep(args.latency)
+
+        if random.random() < args.error_rate:
+            self.send_response(503)
+            self.send_header('Retry-After', str(args.retry_after))
+            self.end_headers()
+            return
+
+        if params.get('verb') != ['ListRecords']:
+            self.send_error(400, 'Only ListRecords verb is supported')
+            return
+
+        if 'resumptionToken' in params:
+            page_id = int(params['resumptionToken'][0].split('|')[0])
+        else:
+            page_id = 0
+
+        if page_id >= self.server.n_pages:
+            self.send_error(404, 'No such page')
+            return
+
+        content = self.server.get_page(page_id)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='[%(asctime)s] %(levelname)s %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+        level=logging.INFO,
+    )
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--metadata-prefix', default='arXiv')
+    parser.add_argument('--replay-dir', help='serve pages harvested earlier instead of synthetic ones')
+    parser.add_argument('--pages', type=int, default=100)
+    parser.add_argument('--records-per-page', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0, help='seconds to wait before each response')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests answered with 503')
+    parser.add_argument('--retry-after', type=int, default=1)
+    args = parser.parse_args()
+
+    server = MockOAIServer((args.host, args.port), args)
+    logger.info('Serving %d pages of %s at http://%s:%d/oai2' % (
+        server.n_pages, args.metadata_prefix, args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info('Stopping')
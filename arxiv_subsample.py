@@ -4,47 +4,219 @@ import os
 import sys
 import logging
 import argparse
-import random
+import hashlib
 import shutil
 import json
+import heapq
+import threading
+import collections
+from multiprocessing.pool import ThreadPool
+
+from arxiv_text_store import open_text_store, read_store_compression, TextStoreWriter, text_name
+from arxiv_metadata_reader import (
+    iterate_arxiv_items,
+    build_jsonlines_index,
+    has_jsonlines_index,
+    read_jsonlines_index,
+    iterate_jsonlines_at,
+)
 
 
 logger = logging.getLogger(__name__)
 
 
-def iterate_arxiv_items(args):
-    if args.metadata is not None:
-        # read from file
-        import json
-        
-        file_reader = open
-        if args.metadata.endswith('.bz2'):
-            import bz2
-            file_reader = bz2.BZ2File
-        elif args.metadata.endswith('.gz'):
-            import gzip
-            file_reader = gzip.GzipFile
-        
-        metadata_file = file_reader(args.metadata)
-        for line in metadata_file:
-            item = json.loads(line)
-            yield item
-            
-    else:
-        # read from mongodb
-        import pymongo
-        
-        client = pymongo.MongoClient(args.db)
-        db_uri_parts = pymongo.uri_parser.parse_uri(args.db)
-        db_name = db_uri_parts['database']
-        collection_name = db_uri_parts['collection'] or 'metadata'
-        
-        arxiv_db = client[db_name]
-        metadata_collection = arxiv_db[collection_name]
-        for item in metadata_collection:
-            yield metadata_collection
-    
-    
+def id_fraction(item_id, seed):
+    """
+    Pseudo-random number in [0, 1) determined by item id and seed, so the
+    same subsample is selected on every run and with or without index.
+    """
+    digest = hashlib.md5(('%s:%s' % (seed, item_id)).encode('utf8')).hexdigest()
+    return int(digest[:13], 16) / float(16 ** 13)
+
+
+def iterate_indexed_items(args):
+    """
+    Select items of args.metadata dump by its index and read only their lines.
+    Returns number of items in date range and iterator of selected items.
+    """
+    locations = []
+    n_indexed = 0
+    for created_date, item_id, offset, length in read_jsonlines_index(
+            args.metadata, args.start_date, args.finish_date):
+        n_indexed += 1
+        if args.subsample_rate is None or id_fraction(item_id, args.seed) < args.subsample_rate:
+            locations.append((offset, length))
+    logger.info('Index: %d items in date range, %d selected' % (n_indexed, len(locations)))
+    return n_indexed, iterate_jsonlines_at(args.metadata, locations)
+
+
+class StratifiedSampler(object):
+    """
+    Exact-size sample of a stream in a single pass: a reservoir per stratum
+    keeps sample_size items with the smallest id_fraction, so the sample is
+    uniform within strata, reproducible by seed and independent of input
+    order. Strata are combinations of primary category ('category') and/or
+    created month ('month') listed in stratify_by; no strata means a single
+    reservoir.
+    """
+
+    def __init__(self, sample_size, stratify_by=(), seed=0):
+        self.sample_size = sample_size
+        self.stratify_by = stratify_by
+        self.seed = seed
+        self.reservoirs = collections.defaultdict(list)
+        self.n_added = 0
+
+    def stratum(self, item):
+        key = []
+        for name in self.stratify_by:
+            if name == 'category':
+                key.append(item['categories'][0] if item.get('categories') else '')
+            elif name == 'month':
+                key.append((item['info'].get('created') or '')[:7])
+        return tuple(key)
+
+    def add(self, item):
+        reservoir = self.reservoirs[self.stratum(item)]
+        # max-heap by fraction; input position breaks ties and restores order
+        entry = (-id_fraction(item['_id'], self.seed), self.n_added, item)
+        self.n_added += 1
+        if len(reservoir) < self.sample_size:
+            heapq.heappush(reservoir, entry)
+        elif entry[0] > reservoir[0][0]:
+            heapq.heapreplace(reservoir, entry)
+
+    def items(self):
+        """
+        Return sampled items of all strata in input order.
+        """
+        entries = sorted(
+            (entry for reservoir in self.reservoirs.values() for entry in reservoir),
+            key=lambda entry: entry[1],
+        )
+        logger.info('Sampled %d items in %d strata' % (len(entries), len(self.reservoirs)))
+        return [item for _, _, item in entries]
+
+
+class StoreTextCopier(object):
+    """
+    Copy texts of selected items from text store to <output_dir>/txt_store
+    as they are, with the same compression.
+    """
+
+    def __init__(self, txt_store, output_dir):
+        self.text_store = open_text_store(txt_store)
+        self.text_store_writer = TextStoreWriter(
+            os.path.join(output_dir, 'txt_store'),
+            compression=read_store_compression(txt_store),
+        )
+        self.n_texts = 0
+
+    def add(self, item_id):
+        text_data = self.text_store.get_raw(text_name(item_id))
+        if text_data is not None:
+            self.n_texts += 1
+            self.text_store_writer.write_raw(text_name(item_id), text_data)
+
+    def close(self):
+        self.text_store_writer.close()
+
+
+# ioctl request cloning file contents on Linux (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def reflink(src, dst):
+    import fcntl
+
+    with open(src, 'rb') as src_file:
+        with open(dst, 'wb') as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+
+
+def link_or_copy(src, dst, mode):
+    """
+    Materialize src at dst by hardlink ('link') or reflink ('reflink') if
+    possible, copying otherwise. Returns method actually used.
+    """
+    if os.path.exists(dst):
+        os.remove(dst)
+    if mode == 'link':
+        try:
+            os.link(src, dst)
+            return 'link'
+        except OSError:
+            pass
+    elif mode == 'reflink':
+        try:
+            reflink(src, dst)
+            return 'reflink'
+        except (IOError, OSError):
+            pass
+    shutil.copy(src, dst)
+    return 'copy'
+
+
+class TextMaterializer(object):
+    """
+    Put texts of selected items to <output_dir>/txt in a pool of threads,
+    with mode 'copy', 'link' or 'reflink' (see link_or_copy). In 'manifest'
+    mode texts stay in place and are listed in <output_dir>/txt_manifest.tsv
+    as item id and path.
+    """
+
+    def __init__(self, txt_dir, output_dir, mode='copy', threads=8):
+        self.txt_dir = txt_dir
+        self.output_dir = output_dir
+        self.mode = mode
+        self.manifest_file = None
+        if mode == 'manifest':
+            self.manifest_file = open(os.path.join(output_dir, 'txt_manifest.tsv'), 'w')
+        self.methods = collections.Counter()
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(4 * threads)
+        self.pool = ThreadPool(threads)
+
+    @property
+    def n_texts(self):
+        return sum(count for method, count in self.methods.items() if method not in ('missing', 'failed'))
+
+    def add(self, item_id):
+        self.slots.acquire()
+        self.pool.apply_async(self.materialize, (item_id,))
+
+    def materialize(self, item_id):
+        try:
+            txt_name = item_id.replace('/', '') + '.txt'
+            txt_file = os.path.join(self.txt_dir, txt_name)
+            if not os.path.exists(txt_file):
+                method = 'missing'
+            elif self.mode == 'manifest':
+                method = 'manifest'
+            else:
+                method = link_or_copy(txt_file, os.path.join(self.output_dir, 'txt', txt_name), self.mode)
+        except Exception:
+            logger.exception('Cannot materialize text of %s' % item_id)
+            method = 'failed'
+        finally:
+            self.slots.release()
+
+        with self.lock:
+            self.methods[method] += 1
+            if method == 'manifest':
+                self.manifest_file.write('%s\t%s\n' % (item_id, os.path.abspath(txt_file)))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        if self.manifest_file is not None:
+            self.manifest_file.close()
+        logger.info('Texts: %s' % ', '.join(
+            '%s %d' % (method, count)
+            for method, count in sorted(self.methods.items())
+        ))
+
+
 if __name__ == '__main__':    
     logger.setLevel(logging.DEBUG)
     log_formatter = logging.Formatter(
@@ -58,39 +230,73 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--db', default='mongodb://localhost:27017/arxiv')
     parser.add_argument('--metadata')
+    parser.add_argument('--metadata-store')
     parser.add_argument('--txt-dir', default='txt')
+    parser.add_argument('--txt-store', help='read texts from sharded text store and write subsample store')
     parser.add_argument('--output-dir')
     parser.add_argument('--subsample-rate', type=float)
     parser.add_argument('--start-date')
     parser.add_argument('--finish-date')
+    parser.add_argument('--seed', type=int, default=0, help='seed of subsample selection')
+    parser.add_argument('--build-index', default=False, action='store_true',
+                        help='index uncompressed --metadata dump to read only selected lines')
+    parser.add_argument('--txt-mode', choices=['copy', 'link', 'reflink', 'manifest'], default='copy',
+                        help='how to put texts to the subsample; link and reflink fall back to copy')
+    parser.add_argument('--copy-threads', type=int, default=8)
+    parser.add_argument('--sample-size', type=int,
+                        help='select exactly this many items (per stratum), after rate and date filters')
+    parser.add_argument('--stratify-by', nargs='+', choices=['category', 'month'], default=[],
+                        help='sample --sample-size items of every primary category and/or created month')
     args = parser.parse_args()
+    if args.stratify_by and args.sample_size is None:
+        parser.error('--stratify-by requires --sample-size')
+
+    if args.build_index:
+        if args.metadata is None:
+            parser.error('--build-index requires --metadata')
+        try:
+            build_jsonlines_index(args.metadata)
+        except ValueError as e:
+            parser.error(str(e))
     
     if not os.path.exists(args.output_dir):
         os.makedirs(os.path.join(args.output_dir, 'txt'))
 
     metadata_subsample_file = open(os.path.join(args.output_dir, 'metadata.jsonlines'), 'w')
 
+    if args.txt_store is not None:
+        texts = StoreTextCopier(args.txt_store, args.output_dir)
+    else:
+        texts = TextMaterializer(args.txt_dir, args.output_dir, args.txt_mode, args.copy_threads)
+
+    sampler = None
+    if args.sample_size is not None:
+        sampler = StratifiedSampler(args.sample_size, args.stratify_by, args.seed)
+
     n_processed = 0
     n_selected = 0
-    n_texts = 0
+    n_indexed = None
 
-    for item in iterate_arxiv_items(args):
+    if args.metadata_store is None and args.metadata is not None and has_jsonlines_index(args.metadata):
+        n_indexed, items = iterate_indexed_items(args)
+    else:
+        items = iterate_arxiv_items(args, start_date=args.start_date, finish_date=args.finish_date)
+
+    for item in items:
         if n_processed % 20000 == 0 and n_processed > 0:
             logger.info('Processed %d items, current_date: %s, selected: %d (%.2f%%), text coverage: %d (%.2f%%)' % (
                         n_processed,
                         created_date,
                         n_selected,
                         float(n_selected) / n_processed * 100,
-                        n_texts,
-                        float(n_texts) / (n_selected + 1e-10) * 100,
+                        texts.n_texts,
+                        float(texts.n_texts) / (n_selected + 1e-10) * 100,
                     ))
 
         n_processed += 1
 
-        if args.subsample_rate is not None:
-            random_number = random.random()
-            if random_number > args.subsample_rate:
-                continue
+        if args.subsample_rate is not None and id_fraction(item['_id'], args.seed) >= args.subsample_rate:
+            continue
 
         created_date = item['info'].get('created')
         if args.start_date is not None and (created_date is None or created_date < args.start_date):
@@ -98,25 +304,35 @@ if __name__ == '__main__':
         if args.finish_date is not None and (created_date is None or created_date > args.finish_date):
             continue
 
-        n_selected += 1
+        if sampler is not None:
+            sampler.add(item)
+            continue
 
+        n_selected += 1
         metadata_subsample_file.write(
             json.dumps(item, separators=(',', ':')) + '\n'
         )
+        texts.add(item['_id'])
 
-        txt_name = item['_id'].replace('/', '') + '.txt'
-        txt_file = os.path.join(args.txt_dir, txt_name)
-        new_txt_file = os.path.join(args.output_dir, 'txt', txt_name)
-        if os.path.exists(txt_file):
-            n_texts += 1
-            shutil.copy(txt_file, new_txt_file)
+    if sampler is not None:
+        for item in sampler.items():
+            n_selected += 1
+            metadata_subsample_file.write(
+                json.dumps(item, separators=(',', ':')) + '\n'
+            )
+            texts.add(item['_id'])
 
     metadata_subsample_file.close()
+    texts.close()
+    n_texts = texts.n_texts
+    if n_indexed is not None:
+        # only selected items were read, the rest was filtered by index
+        n_processed = n_indexed
     
     logger.info('Finished. Selected %d of %d (%.2f%%), text coverage: %d (%.2f%%)' % (
             n_selected,
             n_processed,
-            float(n_selected) / n_processed * 100,
+            float(n_selected) / (n_processed + 1e-10) * 100,
             n_texts,
             float(n_texts) / (n_selected + 1e-10) * 100,
         ))
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+"""
+Sharded store of paper texts, an alternative to a directory of .txt files.
+
+Texts are zlib-compressed one by one (or stored as is) and appended to
+shard files texts-00000.bin, texts-00001.bin, ... An index.tsv file maps
+text name (arXiv id without '/', as in <name>.txt files) to shard, offset
+and length, so a text is read with one seek, and a full scan reads shards
+sequentially. Uncompressed stores can be memory-mapped with
+MappedTextStore, which returns texts without copying them.
+
+Pack a directory of texts into uncompressed store:
+    ./arxiv_text_store.py --txt-dir txt --output-store corpus --compression none
+"""
+
+import os
+import json
+import mmap
+import zlib
+import codecs
+import logging
+import argparse
+
+__all__ = [
+    'text_name',
+    'decode_text',
+    'open_text_store',
+    'TextStore',
+    'MappedTextStore',
+    'TextStoreWriter',
+]
+
+
+logger = logging.getLogger(__name__)
+
+
+INDEX_FILE_NAME = 'index.tsv'
+INFO_FILE_NAME = 'store.json'
+
+
+def text_name(arxiv_id):
+    return arxiv_id.replace('/', '')
+
+
+def shard_file_name(shard_id):
+    return 'texts-%.5d.bin' % shard_id
+
+
+def decode_text(text):
+    """
+    Decode utf8 text returned by a store, accepting bytes or memory views.
+    """
+    return codecs.utf_8_decode(text)[0]
+
+
+def read_store_compression(store_dir):
+    info_filename = os.path.join(store_dir, INFO_FILE_NAME)
+    if not os.path.exists(info_filename):
+        return 'zlib'
+    with open(info_filename) as info_file:
+        return json.load(info_file)['compression']
+
+
+def read_index(store_dir):
+    index = {}
+    with open(os.path.join(store_dir, INDEX_FILE_NAME)) as index_file:
+        for line in index_file:
+            name, shard_id, offset, length = line.rstrip('\n').split('\t')
+            index[name] = (int(shard_id), int(offset), int(length))
+    return index
+
+
+def list_shard_ids(store_dir):
+    shard_ids = []
+    for filename in os.listdir(store_dir):
+        if filename.startswith('texts-') and filename.endswith('.bin'):
+            shard_ids.append(int(filename[len('texts-'):-len('.bin')]))
+    return sorted(shard_ids)
+
+
+class TextStoreWriter(object):
+    """
+    Append texts to the store, continuing the last shard of an existing store.
+
+    Compression is 'zlib' or 'none'; an existing store keeps its own.
+    Every write is flushed, so texts listed in the index survive a crash of
+    the writing process.
+    """
+
+    def __init__(self, store_dir, shard_size=1024**3, compression='zlib', compress_level=6):
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        self.store_dir = store_dir
+        self.shard_size = shard_size
+        self.compress_level = compress_level
+
+        info_filename = os.path.join(store_dir, INFO_FILE_NAME)
+        if os.path.exists(os.path.join(store_dir, INDEX_FILE_NAME)):
+            self.compression = read_store_compression(store_dir)
+        else:
+            self.compression = compression
+            with open(info_filename, 'w') as info_file:
+                json.dump({'compression': compression}, info_file)
+
+        shard_ids = list_shard_ids(store_dir)
+        self.shard_id = shard_ids[-1] if shard_ids else 0
+        self.shard_file = self.open_shard(self.shard_id)
+        self.index_file = open(os.path.join(store_dir, INDEX_FILE_NAME), 'a')
+
+    def open_shard(self, shard_id):
+        shard_file = open(os.path.join(self.store_dir, shard_file_name(shard_id)), 'ab')
+        shard_file.seek(0, os.SEEK_END)
+        return shard_file
+
+    def write(self, name, text):
+        """
+        Add text (utf8 bytes) under name, replacing earlier text with this name.
+        """
+        if self.compression == 'zlib':
+            text = zlib.compress(text, self.compress_level)
+        self.write_raw(name, text)
+
+    def write_raw(self, name, data):
+        """
+        Add text already encoded with the store compression.
+        """
+        offset = self.shard_file.tell()
+        if offset > 0 and offset + len(data) > self.shard_size:
+            self.shard_file.close()
+            self.shard_id += 1
+            self.shard_file = self.open_shard(self.shard_id)
+            offset = 0
+
+        self.shard_file.write(data)
+        self.shard_file.flush()
+        self.index_file.write('%s\t%d\t%d\t%d\n' % (name, self.shard_id, offset, len(data)))
+        self.index_file.flush()
+
+    def close(self):
+        self.shard_file.close()
+        self.index_file.close()
+
+
+class TextStore(object):
+    """
+    Read-only access to the store by text name.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.compression = read_store_compression(store_dir)
+        self.index = read_index(store_dir)
+        self.shard_files = {}
+        logger.info('Opened text store %s with %d texts' % (store_dir, len(self.index)))
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def shard_file(self, shard_id):
+        if shard_id not in self.shard_files:
+            self.shard_files[shard_id] = open(os.path.join(self.store_dir, shard_file_name(shard_id)), 'rb')
+        return self.shard_files[shard_id]
+
+    def get_raw(self, name):
+        location = self.index.get(name)
+        if location is None:
+            return None
+        shard_id, offset, length = location
+        shard_file = self.shard_file(shard_id)
+        shard_file.seek(offset)
+        return shard_file.read(length)
+
+    def get(self, name):
+        """
+        Return text (utf8 bytes) stored under name, or None.
+        """
+        data = self.get_raw(name)
+        if data is not None and self.compression == 'zlib':
+            return zlib.decompress(data)
+        return data
+
+    def iterate(self):
+        """
+        Yield (name, text) pairs reading shards sequentially.
+        """
+        locations = sorted(
+            (location, name)
+            for name, location in self.index.items()
+        )
+        for (shard_id, offset, length), name in locations:
+            shard_file = self.shard_file(shard_id)
+            if shard_file.tell() != offset:
+                shard_file.seek(offset)
+            data = shard_file.read(length)
+            if self.compression == 'zlib':
+                data = zlib.decompress(data)
+            yield name, data
+
+    def close(self):
+        for shard_file in self.shard_files.values():
+            shard_file.close()
+        self.shard_files = {}
+
+
+def mapped_slice(mapped_file, offset, length):
+    try:
+        return memoryview(mapped_file)[offset:offset + length]
+    except TypeError:
+        # mmap of Python 2 supports only the old buffer interface
+        return buffer(mapped_file, offset, length)
+
+
+class MappedTextStore(object):
+    """
+    Read-only access to uncompressed store through memory-mapped shards.
+
+    Texts are returned as memory views into the shard files, without
+    reading or copying them; processes mapping the same store share the
+    page cache.
+    """
+
+    def __init__(self, store_dir):
+        if read_store_compression(store_dir) != 'none':
+            raise ValueError('Only uncompressed text store can be memory-mapped: %s' % store_dir)
+        self.store_dir = store_dir
+        self.index = read_index(store_dir)
+        self.shard_files = {}
+        self.shard_maps = {}
+        logger.info('Mapped text store %s with %d texts' % (store_dir, len(self.index)))
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def shard_map(self, shard_id):
+        if shard_id not in self.shard_maps:
+            shard_file = open(os.path.join(self.store_dir, shard_file_name(shard_id)), 'rb')
+            self.shard_files[shard_id] = shard_file
+            self.shard_maps[shard_id] = mmap.mmap(shard_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.shard_maps[shard_id]
+
+    def get(self, name):
+        """
+        Return memory view of text (utf8) stored under name, or None.
+        """
+        location = self.index.get(name)
+        if location is None:
+            return None
+        shard_id, offset, length = location
+        return mapped_slice(self.shard_map(shard_id), offset, length)
+
+    get_raw = get
+
+    def iterate(self):
+        """
+        Yield (name, memory view of text) pairs in shard order.
+        """
+        locations = sorted(
+            (location, name)
+            for name, location in self.index.items()
+        )
+        for (shard_id, offset, length), name in locations:
+            yield name, mapped_slice(self.shard_map(shard_id), offset, length)
+
+    def close(self):
+        # memory views handed out keep maps alive until they are released
+        self.shard_maps = {}
+        for shard_file in self.shard_files.values():
+            shard_file.close()
+        self.shard_files = {}
+
+
+def open_text_store(store_dir):
+    """
+    Open store for reading, memory-mapped if it is uncompressed.
+    """
+    if read_store_compression(store_dir) == 'none':
+        return MappedTextStore(store_dir)
+    return TextStore(store_dir)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='[%(asctime)s] %(levelname)s %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+        level=logging.INFO,
+    )
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--txt-dir', help='pack <name>.txt files of this directory')
+    parser.add_argument('--input-store', help='repack existing text store')
+    parser.add_argument('--output-store', required=True)
+    parser.add_argument('--compression', choices=['zlib', 'none'], default='none')
+    parser.add_argument('--shard-size-mb', type=int, default=1024)
+    args = parser.parse_args()
+
+    writer = TextStoreWriter(
+        args.output_store,
+        shard_size=args.shard_size_mb * 1024**2,
+        compression=args.compression,
+    )
+    if args.input_store is not None:
+        texts = open_text_store(args.input_store).iterate()
+    elif args.txt_dir is not None:
+        def iterate_txt_dir(txt_dir):
+            for filename in sorted(os.listdir(txt_dir)):
+                if filename.endswith('.txt'):
+                    with open(os.path.join(txt_dir, filename), 'rb') as txt_file:
+                        yield filename[:-len('.txt')], txt_file.read()
+        texts = iterate_txt_dir(args.txt_dir)
+    else:
+        parser.error('Either --txt-dir or --input-store is required')
+
+    for n, (name, text) in enumerate(texts):
+        writer.write(name, bytes(text))
+        if n % 10000 == 0 and n > 0:
+            logger.info('Packed %d texts' % n)
+    writer.close()
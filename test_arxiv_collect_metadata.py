@@ -0,0 +1,51 @@
+import unittest
+
+import pymongo
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+from arxiv_collect_metadata import update_metadata_batch, update_metadata
+
+
+def mongomock_supports_bulk_write():
+    try:
+        mongomock.MongoClient().db.test.bulk_write([pymongo.UpdateOne({'_id': 0}, {'$set': {'a': 1}})])
+    except TypeError:
+        # pymongo is newer than mongomock supports
+        return False
+    return True
+
+
+@unittest.skipIf(mongomock is None, 'mongomock is not installed')
+class UpdateMetadataTest(unittest.TestCase):
+
+    def setUp(self):
+        if not mongomock_supports_bulk_write():
+            self.skipTest('mongomock does not support bulk_write of pymongo %s' % pymongo.version)
+        self.collection = mongomock.MongoClient().arxiv.metadata
+        self.collection.insert_many([
+            {'_id': '0704.0001'},
+            {'_id': '0704.0002', 'submitter': 'Doe'},
+        ])
+        self.update_requests = [
+            pymongo.UpdateOne({'_id': '0704.0001'}, {'$set': {'submitter': 'Roe'}}),
+            pymongo.UpdateOne({'_id': '0704.0002'}, {'$set': {'submitter': 'Doe'}}),
+            pymongo.UpdateOne({'_id': '0704.0003'}, {'$set': {'submitter': 'Poe'}}),
+        ]
+
+    def test_batch_counters(self):
+        matched, modified, missing = update_metadata_batch(self.collection, self.update_requests)
+        self.assertEqual((matched, modified, missing), (2, 1, 1))
+        self.assertEqual(self.collection.find_one({'_id': '0704.0001'})['submitter'], 'Roe')
+        self.assertIsNone(self.collection.find_one({'_id': '0704.0003'}))
+
+    def test_counters_summed_over_batches(self):
+        counters = update_metadata(self.collection, iter(self.update_requests), batch_size=2)
+        self.assertEqual(list(counters), [2, 1, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()